@@ -1,18 +1,38 @@
 """Matrix bridge for a listener."""
-import urllib.request
+import html
+import http.client
 import json
+import queue
+import threading
+import time
+import urllib.parse
 
 
 class Module(object):
     """Bridge implementation."""
 
+    _env = "/etc/epiphyte.d/environment"
     _url = "{}/_matrix/client/r0/rooms/{}/send/m.room.message?access_token={}"
-    _body = "<body><pre>{}\n{}\n---\n{}</pre></body>"
+    _body = "<body><pre>{}</pre></body>"
+    _entry = "{}\n{}\n---\n{}"
+    # messages arriving within the window are posted as one matrix event
+    _window = 1.0
+    _batch = 50
+    _queue = 1000
+    _timeout = 10
+    # seconds between queue full warnings (the first drop always warns)
+    _notify = 60
 
     def __init__(self):
         """Init definition."""
         self._post = None
         self._init = False
+        self._log = None
+        self._conn = None
+        self._pending = queue.Queue(maxsize=self._queue)
+        self._thread = None
+        self._warned = None
+        self.dropped = 0
 
     def _load_env(self, log):
         """Load environment."""
@@ -20,7 +40,7 @@ class Module(object):
         token = None
         url = None
         log.info("loading env vars")
-        with open("/etc/epiphyte.d/environment", 'r') as f:
+        with open(self._env, 'r') as f:
             for line in f:
                 kv = line.split("=")
                 if len(kv) == 2:
@@ -36,12 +56,78 @@ class Module(object):
         if room is not None and token is not None and url is not None:
             self._post = self._url.format(url, room, token)
 
+    def _connect(self):
+        """Open (or reuse) the kept-alive homeserver connection."""
+        if self._conn is None:
+            parts = urllib.parse.urlsplit(self._post)
+            if parts.scheme == "https":
+                self._conn = http.client.HTTPSConnection(parts.netloc,
+                                                         timeout=self._timeout)
+            else:
+                self._conn = http.client.HTTPConnection(parts.netloc,
+                                                        timeout=self._timeout)
+        return self._conn
+
+    def _send(self, entries):
+        """Post a batch of entries as one matrix event."""
+        obj = {}
+        obj["body"] = "\n".join(["{},{} -> {}".format(*x) for x in entries])
+        formatted = [self._entry.format(*[html.escape(y) for y in x])
+                     for x in entries]
+        obj["formatted_body"] = self._body.format("\n\n".join(formatted))
+        obj["msgtype"] = "m.text"
+        obj["format"] = "org.matrix.custom.html"
+        data = json.dumps(obj).encode("utf-8")
+        parts = urllib.parse.urlsplit(self._post)
+        path = parts.path + "?" + parts.query
+        headers = {'Content-Type': 'application/json; charset=utf-8'}
+        # NOTE: a kept-alive connection may have been closed by the server
+        for attempt in range(2):
+            try:
+                conn = self._connect()
+                conn.request("POST", path, data, headers)
+                resp = conn.getresponse()
+                resp.read()
+                if resp.status >= 400:
+                    self._log.warn("matrix post failed: " + str(resp.status))
+                return
+            except (http.client.HTTPException, OSError):
+                if self._conn is not None:
+                    self._conn.close()
+                    self._conn = None
+                if attempt > 0:
+                    raise
+
+    def _worker(self):
+        """Post queued messages in batches."""
+        while True:
+            entries = [self._pending.get()]
+            deadline = time.monotonic() + self._window
+            while len(entries) < self._batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    entries.append(self._pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._send(entries)
+            except Exception as e:
+                self._log.error("matrix bridge error")
+                self._log.error(str(e))
+
     def handle(self, connection, event, log):
         """required method and signuatre for gliobal message handling."""
         try:
             if not self._init:
                 self._init = True
+                self._log = log
                 self._load_env(log)
+                if self._post is not None:
+                    self._thread = threading.Thread(target=self._worker,
+                                                    daemon=True)
+                    self._thread.start()
             if self._post is None:
                 log.warn("no post settings enabled")
                 return
@@ -49,20 +135,18 @@ class Module(object):
             data = event.arguments
             if data and len(data) > 0:
                 for d in data:
-                    obj = {}
-                    obj["body"] = "{},{} -> {}".format(event.source,
-                                                       event.target,
-                                                       str(d))
-                    obj["formatted_body"] = self._body.format(event.source,
-                                                              event.target,
-                                                              str(d))
-                    obj["msgtype"] = "m.text"
-                    obj["format"] = "org.matrix.custom.html"
-                    req = urllib.request.Request(self._post)
-                    req.add_header('Content-Type',
-                                   'application/json; charset=utf-8')
-                    urllib.request.urlopen(req,
-                                           json.dumps(obj).encode("utf-8"))
+                    try:
+                        self._pending.put_nowait((str(event.source),
+                                                  str(event.target),
+                                                  str(d)))
+                    except queue.Full:
+                        self.dropped += 1
+                        now = time.monotonic()
+                        if self._warned is None or \
+                           now - self._warned >= self._notify:
+                            self._warned = now
+                            log.warn("matrix bridge queue full, dropped: " +
+                                     str(self.dropped))
         except Exception as e:
             log.error("matrix bridge error")
             log.error(str(e))
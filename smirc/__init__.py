@@ -1,3 +1,3 @@
 #!/usr/bin/python
 """Empty init for smirc."""
-from smirc.smirc import run
+from smirc.smirc import run, Client, AioClient
@@ -1,22 +1,23 @@
 #!/usr/bin/python
 """IRC control/status bot."""
-import irc.connection as conn
-import ssl
-import irc.client as client
+# NOTE: bot-only dependencies (irc, ssl, asyncio, systemd, subprocess...)
+# are imported where they are used so the client starts quickly
 import argparse
+import binascii
+import bisect
+import codecs
+import collections
+import fnmatch
+import functools
 import time
-import zmq
 import threading
-from multiprocessing import Queue
-from queue import Empty
+from queue import Empty, Queue
 import os
-import socket
+import re
+import select
 import json
 import sys
 import logging
-from systemd.journal import JournalHandler
-import subprocess
-import importlib.util
 
 VERS = "__VERSION__"
 
@@ -27,9 +28,14 @@ JOINT = True
 CONTEXT = None
 RESET = False
 KILLED = False
+RELOAD = False
 LAST_PONG = 0
 RETRIES = 0
 REPORTED_IN = False
+WAKE = None
+OUTBOUND = None
+WORKERS = None
+HANDLERS = None
 lock = threading.RLock()
 
 # events
@@ -39,6 +45,9 @@ DEBUG = IND + "debug"
 HELP = IND + "help"
 RESTART = IND + "restart"
 KILL = IND + "killkillkill"
+STATS = IND + "stats"
+RELOAD_CMD = IND + "reload"
+PROFILE = IND + "profile"
 
 # help text
 HELP_RAW = {}
@@ -46,6 +55,9 @@ HELP_RAW[STATUS] = "check status"
 HELP_RAW[DEBUG] = "change debug output/toggle"
 HELP_RAW[RESTART] = "restart the bot"
 HELP_RAW[KILL] = "kill the bot (full service reboot)"
+HELP_RAW[STATS] = "report runtime metrics"
+HELP_RAW[RELOAD_CMD] = "reload the config and changed modules"
+HELP_RAW[PROFILE] = "start/stop the profiler (the report is written to disk)"
 HELP_TEXT = "\n".join(["{} => {}".format(x, HELP_RAW[x]) for x in HELP_RAW])
 
 # ZMQ thread
@@ -54,6 +66,44 @@ _TYPE = "type"
 _DATA = "data"
 _PRIV_TYPE = "priv"
 _PUB_TYPE = "pub"
+_STATS_TYPE = "stats"
+_PROFILE_TYPE = "profile"
+_RECV = "recv"
+_CHUNK = "chunk"
+_SEQ = "seq"
+_MORE = "more"
+_WHOLE = "whole"
+_REPLY_TYPE = "reply"
+_HOST = "host"
+_CHANNEL = "channel"
+_COMMAND = "command"
+_PRIORITY = "priority"
+_ID = "id"
+_ACK = "ack"
+
+# message priority classes, highest first
+_CRITICAL = "critical"
+_HIGH = "high"
+_NORMAL = "normal"
+_BULK = "bulk"
+_PRIORITIES = [_CRITICAL, _HIGH, _NORMAL, _BULK]
+_NORMAL_LEVEL = _PRIORITIES.index(_NORMAL)
+
+# fleet summaries, groups up to this size list their hosts
+_FLEET_NAMES = 3
+
+# ZMQ ingest socket types
+_REP_INGEST = "rep"
+_ROUTER_INGEST = "router"
+_PULL_INGEST = "pull"
+_INGEST_TYPES = {}
+_INGEST_TYPES[_REP_INGEST] = "REP"
+_INGEST_TYPES[_ROUTER_INGEST] = "ROUTER"
+_INGEST_TYPES[_PULL_INGEST] = "PULL"
+
+# Bot loop modes
+_AIO_MODE = "async"
+_REACTOR_MODE = "reactor"
 
 # Command types
 _CMD_TYPE = "commands"
@@ -65,20 +115,663 @@ _PRIVATE_FLAG = "--private"
 _TO_FLAG = "--to"
 _BOT_FLAG = "--bot"
 _CONFIG_FLAG = "--config"
+_STREAM_FLAG = "--stream"
+_STATS_FLAG = "--stats"
+_PRIORITY_FLAG = "--priority"
+_PROFILE_FLAG = "--profile"
+
+# profiler actions
+_PROFILE_START = "start"
+_PROFILE_STOP = "stop"
+
+# streaming client, longest partial line held before it is sent
+_STREAM_PARTIAL = 4096
+
+# spool files
+_SPOOL_EXT = ".spool"
+_SPOOL_HEAD = "head.json"
+_SPOOL_CURSOR = "cursor"
+
+# outbound coalescing, numbers are ignored when comparing lines
+_DIGITS = re.compile(r"\d+")
+# NOTE: settings read once at startup, a reload can not apply them
+_RESTART_KEYS = ["server",
+                 "port",
+                 "password",
+                 "zmq",
+                 "endpoint",
+                 "ingest",
+                 "mode",
+                 "pool",
+                 "spool",
+                 "spool_memory",
+                 "spool_segment",
+                 "workers",
+                 "worker_backlog",
+                 "module_workers",
+                 "module_backlog",
+                 "message_lines",
+                 "chunk_timeout",
+                 "priority_share"]
+
+
+class _Journal(logging.Handler):
+    """Journal log handler, systemd is imported once something is logged."""
+
+    def __init__(self):
+        """Init the instance."""
+        logging.Handler.__init__(self)
+        self._handler = None
+
+    def emit(self, record):
+        """Emit a record to the journal."""
+        try:
+            if self._handler is None:
+                from systemd.journal import JournalHandler
+                self._handler = JournalHandler(SYSLOG_IDENTIFIER='smirc')
+            self._handler.handle(record)
+        except Exception:
+            self.handleError(record)
+
 
 # logging
 log = logging.getLogger('smirc')
-log.addHandler(JournalHandler(SYSLOG_IDENTIFIER='smirc'))
+log.addHandler(_Journal())
 log.setLevel(logging.INFO)
 
 
-def _send_lines(c, targets, val):
-    """Send lines."""
-    for item in val.split("\n"):
-        if len(item.strip()) == 0:
-            continue
-        for target in targets:
-            c.privmsg(target, item)
+def _send_lines(c, targets, val, stamp=None, priority=None, coalesce=False):
+    """Send lines (priority is the class level, normal by default).
+
+    With coalesce the lines are one whole message, repeats of which are
+    coalesced (the lines themselves never are).
+    """
+    lines = [x for x in val.split("\n") if len(x.strip()) > 0]
+    for target in targets:
+        if OUTBOUND is None or isinstance(c, Relay):
+            for item in lines:
+                c.privmsg(target, item)
+        elif coalesce:
+            OUTBOUND.push_message(target,
+                                  lines,
+                                  stamp=stamp,
+                                  priority=priority)
+        else:
+            for item in lines:
+                OUTBOUND.push(target, item, stamp=stamp, priority=priority)
+    if OUTBOUND is not None:
+        _wake()
+
+
+def _priority(message):
+    """Priority class level of a queued message."""
+    name = message.get(_PRIORITY, _NORMAL)
+    if name not in _PRIORITIES:
+        return _NORMAL_LEVEL
+    return _PRIORITIES.index(name)
+
+
+class Share(object):
+    """Strict priority by level, with a reserved share for lower levels.
+
+    Every 1/share-th pick goes to the lower waiting level served least
+    recently, so lower levels are slowed down but never starved.
+    """
+
+    def __init__(self, levels, share=0.1):
+        """Init the instance."""
+        self.share = share
+        self._turn = 0
+        self._served = [0] * levels
+
+    def pick(self, waiting):
+        """Pick a level from the waiting levels (highest first) or None."""
+        if len(waiting) == 0:
+            return None
+        self._turn += 1
+        level = waiting[0]
+        if len(waiting) > 1 and self.share > 0 and \
+           self._turn % max(1, int(round(1 / self.share))) == 0:
+            level = min(waiting[1:], key=lambda x: self._served[x])
+        self._served[level] = self._turn
+        return level
+
+
+class Outbound(object):
+    """Outbound scheduler, per-connection token buckets over fair queues.
+
+    Each priority class has its own round-robin queues by target.
+    """
+
+    def __init__(self, rate, burst, coalesce=0, cache=1024, share=0.1):
+        """Init the instance."""
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.coalesce = coalesce
+        self.cache = max(1, cache)
+        self._buckets = {}
+        self._levels = [collections.OrderedDict() for x in _PRIORITIES]
+        self._share = Share(len(_PRIORITIES), share)
+        self._seen = collections.OrderedDict()
+        self._windows = collections.deque()
+        self._lock = threading.RLock()
+
+    def tune(self, rate, burst, coalesce, cache):
+        """Apply new pacing and coalescing settings."""
+        with self._lock:
+            self.rate = float(rate)
+            self.burst = max(1, burst)
+            self.coalesce = coalesce
+            self.cache = max(1, cache)
+
+    def push(self, target, line, stamp=None, priority=None):
+        """Queue a line for a target (stamp is the enqueue time)."""
+        level = _NORMAL_LEVEL if priority is None else priority
+        with self._lock:
+            self._append(target, line, stamp, level)
+
+    def push_message(self, target, lines, stamp=None, priority=None):
+        """Queue a whole message's lines, coalescing repeats of it."""
+        if len(lines) == 0:
+            return
+        level = _NORMAL_LEVEL if priority is None else priority
+        with self._lock:
+            if self.coalesce > 0 and self._repeat(target, lines, level):
+                return
+            for line in lines:
+                self._append(target, line, stamp, level)
+
+    def _append(self, target, line, stamp=None, level=_NORMAL_LEVEL):
+        """Append a line to the target's queue."""
+        queues = self._levels[level]
+        if target not in queues:
+            queues[target] = collections.deque()
+        queues[target].append((line, stamp))
+
+    def _repeat(self, target, lines, level=_NORMAL_LEVEL):
+        """Track a message, True when it repeats one sent within the window."""
+        now = time.monotonic()
+        text = "\n".join([" ".join(x.split()) for x in lines])
+        key = (target, _DIGITS.sub("#", text))
+        entry = self._seen.get(key, None)
+        if entry is not None:
+            if now - entry[0] < self.coalesce:
+                entry[1] = now
+                entry[2] += 1
+                entry[3] = lines
+                # NOTE: recency (eviction) order only, windows still close
+                # in first seen order
+                self._seen.move_to_end(key)
+                METRICS.incr("coalesced")
+                return True
+            del self._seen[key]
+            self._summary(key, entry)
+        # NOTE: first seen, last repeat, repeats, lines, first seen (wall
+        # clock), level
+        entry = [now, now, 0, lines, time.time(), level]
+        self._seen[key] = entry
+        self._windows.append((key, entry))
+        if len(self._seen) > self.cache:
+            self._summary(*self._seen.popitem(last=False))
+        return False
+
+    def _summary(self, key, entry):
+        """Queue the summary (the last repeat) for repeats of a message."""
+        if entry[2] == 0:
+            return
+        last = entry[4] + entry[1] - entry[0]
+        for line in entry[3][:-1]:
+            self._append(key[0], line, level=entry[5])
+        self._append(key[0], "{} (repeated {}x, {} - {})".format(
+            entry[3][-1],
+            entry[2],
+            time.strftime("%H:%M:%S", time.localtime(entry[4])),
+            time.strftime("%H:%M:%S", time.localtime(last))),
+            level=entry[5])
+
+    def _expire(self):
+        """Close coalescing windows, returns the wait for the next close."""
+        now = time.monotonic()
+        while len(self._windows) > 0:
+            key, entry = self._windows[0]
+            if self._seen.get(key, None) is not entry:
+                # NOTE: evicted (and summarized) already
+                self._windows.popleft()
+                continue
+            wait = entry[0] + self.coalesce - now
+            if wait > 0:
+                return wait
+            self._windows.popleft()
+            del self._seen[key]
+            self._summary(key, entry)
+        return None
+
+    def drain(self):
+        """Take every queued line (pending repeat summaries included).
+
+        Returns (level, target, lines, stamp) per target, in queue order.
+        """
+        with self._lock:
+            while len(self._seen) > 0:
+                self._summary(*self._seen.popitem(last=False))
+            self._windows.clear()
+            result = []
+            for level, queues in enumerate(self._levels):
+                for target in queues:
+                    lines = queues[target]
+                    result.append((level,
+                                   target,
+                                   [x[0] for x in lines],
+                                   lines[0][1]))
+                queues.clear()
+            return result
+
+    def pending(self):
+        """Count queued lines."""
+        with self._lock:
+            return sum([self._depth(x) for x in range(len(self._levels))])
+
+    def _depth(self, level):
+        """Count queued lines of a level."""
+        return sum([len(x) for x in self._levels[level].values()])
+
+    def room(self, limit):
+        """Levels with fewer than limit lines queued."""
+        with self._lock:
+            return [x for x in range(len(self._levels))
+                    if self._depth(x) < limit]
+
+    def _take(self, c):
+        """Take a connection's send token, returns the wait for one."""
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        bucket = self._buckets.get(id(c), None)
+        if bucket is None:
+            bucket = [float(self.burst), now]
+            self._buckets[id(c)] = bucket
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            return (1 - bucket[0]) / self.rate
+        bucket[0] -= 1
+        return 0
+
+    def flush(self, c):
+        """Send lines round-robin by target as tokens allow.
+
+        c is a connection or a list of (pool) connections, each paced by its
+        own bucket. Returns the seconds until the next line can go out (or the
+        next coalescing window closes) or None when nothing is waiting.
+        """
+        conns = c if isinstance(c, list) else [c]
+        with self._lock:
+            live = set([id(x) for x in conns])
+            for key in [x for x in self._buckets if x not in live]:
+                del self._buckets[key]
+            expire = None
+            if self.coalesce > 0:
+                expire = self._expire()
+            wait = self._send(conns)
+            if wait is None or (expire is not None and expire < wait):
+                return expire
+            return wait
+
+    def _send(self, conns):
+        """Send queued lines, returns the wait for a token (or None)."""
+        conns = list(conns)
+        while len(conns) > 0:
+            waiting = [x for x in range(len(self._levels))
+                       if len(self._levels[x]) > 0]
+            if len(waiting) == 0:
+                break
+            waits = []
+            c = None
+            for item in conns:
+                wait = self._take(item)
+                if wait == 0:
+                    c = item
+                    break
+                waits.append(wait)
+            if c is None:
+                return min(waits)
+            # NOTE: rotate so pool members share the load
+            conns.remove(c)
+            conns.append(c)
+            level = self._share.pick(waiting)
+            queues = self._levels[level]
+            target = next(iter(queues))
+            lines = queues[target]
+            entry = lines.popleft()
+            if len(lines) == 0:
+                del queues[target]
+            else:
+                queues.move_to_end(target)
+            try:
+                c.privmsg(target, entry[0])
+            except Exception as e:
+                # NOTE: keep the line (and its turn) for the next flush
+                if target not in queues:
+                    queues[target] = collections.deque()
+                queues[target].appendleft(entry)
+                queues.move_to_end(target, last=False)
+                if len(conns) == 1:
+                    raise
+                log.warning("pool member send failed")
+                log.warning(e)
+                conns.remove(c)
+                continue
+            METRICS.incr("sent")
+            METRICS.incr("sent " + target)
+            if entry[1] is not None:
+                latency = time.time() - entry[1]
+                METRICS.observe("delivery", latency)
+                METRICS.observe("delivery " + _PRIORITIES[level], latency)
+        return None
+
+
+class Stats(object):
+    """In-process counters, latency histograms and gauges."""
+
+    # NOTE: histogram bucket upper bounds in seconds
+    _buckets = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+                1, 2, 5, 10, 30, 60, 300]
+
+    def __init__(self):
+        """Init the instance."""
+        self.started = time.monotonic()
+        self._counters = {}
+        self._rates = {}
+        self._hists = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, count=1):
+        """Increment a counter."""
+        second = int(time.monotonic())
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + count
+            if name not in self._rates:
+                self._rates[name] = collections.deque(maxlen=60)
+            rate = self._rates[name]
+            if len(rate) > 0 and rate[-1][0] == second:
+                rate[-1][1] += count
+            else:
+                rate.append([second, count])
+
+    def observe(self, name, seconds):
+        """Record a duration."""
+        idx = bisect.bisect_left(self._buckets, seconds)
+        with self._lock:
+            if name not in self._hists:
+                self._hists[name] = [0, 0.0, 0.0,
+                                     [0] * (len(self._buckets) + 1)]
+            hist = self._hists[name]
+            hist[0] += 1
+            hist[1] += seconds
+            hist[2] = max(hist[2], seconds)
+            hist[3][idx] += 1
+
+    def gauge(self, name, fxn):
+        """Register a gauge, fxn is read at snapshot time."""
+        with self._lock:
+            self._gauges[name] = fxn
+
+    def _quantile(self, hist, q):
+        """Approximate quantile (bucket upper bound) in seconds."""
+        want = q * hist[0]
+        seen = 0
+        for idx in range(len(hist[3])):
+            seen += hist[3][idx]
+            if seen >= want and seen > 0:
+                if idx < len(self._buckets):
+                    return min(self._buckets[idx], hist[2])
+                break
+        return hist[2]
+
+    def snapshot(self):
+        """Get all metrics (machine-readable)."""
+        now = time.monotonic()
+        with self._lock:
+            gauges = dict(self._gauges)
+            result = {}
+            result["uptime"] = round(now - self.started, 3)
+            result["counters"] = dict(self._counters)
+            result["rates"] = {}
+            for name in self._rates:
+                total = sum([x[1] for x in self._rates[name]
+                             if x[0] > now - 60])
+                result["rates"][name] = round(total / 60.0, 3)
+            result["latency"] = {}
+            for name in self._hists:
+                hist = self._hists[name]
+                obj = {}
+                obj["count"] = hist[0]
+                obj["mean"] = round(hist[1] / hist[0], 6)
+                obj["p50"] = round(self._quantile(hist, 0.5), 6)
+                obj["p99"] = round(self._quantile(hist, 0.99), 6)
+                obj["max"] = round(hist[2], 6)
+                result["latency"][name] = obj
+        result["gauges"] = {}
+        for name in gauges:
+            try:
+                result["gauges"][name] = gauges[name]()
+            except Exception as e:
+                log.debug(e)
+        return result
+
+    def lines(self):
+        """Get all metrics (human-readable)."""
+        snap = self.snapshot()
+        gauges = ["{} {}".format(k, v) for k, v in snap["gauges"].items()]
+        lines = [" ".join(["uptime {}s".format(int(snap["uptime"]))] +
+                          gauges)]
+        for name in sorted(snap["counters"]):
+            lines.append("{} {} ({}/s)".format(name,
+                                               snap["counters"][name],
+                                               snap["rates"][name]))
+        for name in sorted(snap["latency"]):
+            obj = snap["latency"][name]
+            lines.append("{} n={} p50={}ms p99={}ms max={}ms".format(
+                name,
+                obj["count"],
+                int(obj["p50"] * 1000),
+                int(obj["p99"] * 1000),
+                int(obj["max"] * 1000)))
+        return lines
+
+
+METRICS = Stats()
+
+
+class Profiler(object):
+    """On-demand sampling profiler (collapsed stacks) and tracemalloc.
+
+    Samples are wall-clock: every thread is sampled, idle ones included
+    (their stacks end in a wait/select).
+    """
+
+    def __init__(self):
+        """Init the instance."""
+        self.running = False
+        self.files = None
+        self._pending = None
+        self._thread = None
+        self._halt = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self, prefix, interval, limit, top=25):
+        """Start profiling, False when already running.
+
+        The report is written to prefix.collapsed/prefix.txt once stopped
+        (or after limit seconds).
+        """
+        import tracemalloc
+        with self._lock:
+            if self.running:
+                return False
+            self.running = True
+            self.files = None
+            self._pending = [prefix + ".collapsed", prefix + ".txt"]
+            self._halt.clear()
+            tracemalloc.start()
+            self._thread = threading.Thread(target=self._sample,
+                                            args=(prefix,
+                                                  interval,
+                                                  limit,
+                                                  top))
+            self._thread.daemon = True
+            self._thread.start()
+        return True
+
+    def stop(self, wait=True):
+        """Stop profiling, returns the report files (None if never run).
+
+        Without wait the sampler is still writing the report files.
+        """
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is None:
+            return None
+        self._halt.set()
+        if not wait:
+            return self._pending
+        thread.join()
+        return self.files
+
+    def _sample(self, prefix, interval, limit, top):
+        """Sample every thread's stack until stopped."""
+        me = threading.get_ident()
+        stacks = collections.Counter()
+        samples = 0
+        started = time.monotonic()
+        while not self._halt.wait(interval):
+            if time.monotonic() - started > limit:
+                break
+            names = dict([(x.ident, x.name) for x in threading.enumerate()])
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{}:{}".format(
+                        os.path.basename(code.co_filename),
+                        code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[";".join(reversed(stack))] += 1
+            samples += 1
+        try:
+            self.files = self._report(self._pending,
+                                      stacks,
+                                      samples,
+                                      time.monotonic() - started,
+                                      top)
+            log.info("profile written: " + " ".join(self.files))
+        except Exception as e:
+            log.warning("profile report failed")
+            log.warning(e)
+            self.files = []
+        finally:
+            self.running = False
+
+    def _report(self, files, stacks, samples, elapsed, top):
+        """Write the collapsed stacks and the timing/memory report."""
+        import tracemalloc
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        collapsed, report = files
+        path = os.path.dirname(collapsed)
+        if len(path) > 0:
+            os.makedirs(path, exist_ok=True)
+        with open(collapsed, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write("{} {}\n".format(stack, count))
+        with open(report, "w") as f:
+            f.write("samples {} over {:.1f}s\n".format(samples, elapsed))
+            f.write("\ntimings (seconds)\n")
+            latency = METRICS.snapshot()["latency"]
+            for name in sorted(latency):
+                f.write("{} n={count} mean={mean} p50={p50} p99={p99} "
+                        "max={max}\n".format(name, **latency[name]))
+            f.write("\nmemory current={} peak={}\n".format(current, peak))
+            for stat in snapshot.statistics("lineno")[:top]:
+                f.write("{}\n".format(stat))
+        return files
+
+
+PROFILER = Profiler()
+
+
+def _profiled(fn):
+    """Time a handler (as "profile <name>") while the profiler runs."""
+    name = "profile " + fn.__name__.lstrip("_")
+
+    @functools.wraps(fn)
+    def _timed(*args, **kwargs):
+        if not PROFILER.running:
+            return fn(*args, **kwargs)
+        started = time.monotonic()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            METRICS.observe(name, time.monotonic() - started)
+    return _timed
+
+
+def _profile(action, wait=True):
+    """Start/stop the profiler, returns the outcome.
+
+    Without wait stopping returns at once, the report is written meanwhile.
+    """
+    import tempfile
+    with lock:
+        args = CONTEXT
+    if action == _PROFILE_START:
+        prefix = os.path.join(args.profile_dir or tempfile.gettempdir(),
+                              "smirc-{}-{}".format(
+                                  args.name,
+                                  time.strftime("%Y%m%d-%H%M%S")))
+        if not PROFILER.start(prefix,
+                              args.profile_interval,
+                              args.profile_limit,
+                              top=args.profile_top):
+            return "profiler already running"
+        return "profiling, stops after {}s".format(args.profile_limit)
+    if action == _PROFILE_STOP:
+        files = PROFILER.stop(wait=wait)
+        if files is None:
+            return "profiler not running"
+        if not wait:
+            return "profile stopping, writing: " + " ".join(files)
+        return "profile written: " + " ".join(files)
+    return "unknown profiler action: " + str(action)
+
+
+def _wake():
+    """Wake the event-driven bot loop (no-op for the reactor loop)."""
+    if WAKE is not None:
+        WAKE()
+
+
+def _targets(args, val):
+    """Resolve the targets for a queued message."""
+    targets = []
+    to = val[_TYPE]
+    if JOINT:
+        for item in args.rooms:
+            if _PUB_TYPE in to:
+                targets.append(item)
+            elif item in to:
+                targets.append(item)
+    if HOST and _PRIV_TYPE in to:
+        targets.append(args.hostname)
+    if len(targets) == 0:
+        log.warn("no targets for message")
+    return targets
 
 
 def on_connect(connection, event):
@@ -93,76 +786,316 @@ def on_connect(connection, event):
         for item in CONTEXT.rooms:
             connection.join(item)
         RETRIES = 0
+    _wake()
+
+
+def on_disconnect(connection, event):
+    """On connection lost."""
+    log.info("disconnected")
+    global RESET
+    with lock:
+        RESET = True
+    _wake()
 
 
+@_profiled
 def _act(connection, event, permitted):
     """Perform an action."""
-    global HOST
-    global JOINT
-    global CONTEXT
-    global RESET
-    global KILLED
     data = event.arguments
     if data and len(data) > 0:
         for d in data:
             if d.startswith(IND):
-                if d == STATUS:
-                    connection.privmsg(event.target, "alive: " + VERS)
+                parts = d.split(" ")
+                with lock:
+                    action = CONTEXT.dispatch.table.get(parts[0], None)
+                if parts[0] == STATUS:
+                    action(connection, event, parts)
                     return
                 # NOTE: Commands after this section require permission
-                if not permitted:
+                if not Acl.allows(permitted, parts[0], event.target):
                     log.warn("not permitted user requested: " + d)
                     return
-                if d == DEBUG:
-                    with lock:
-                        msg = "public"
-                        if CONTEXT.hostname == event.target:
-                            msg = "private"
-                            HOST = True
-                            JOINT = False
-                        elif event.target in CONTEXT.rooms:
-                            HOST = True
-                            JOINT = True
-                        connection.privmsg(event.target, msg)
-                if d == HELP:
-                    _send_lines(connection, [event.target], HELP_TEXT)
-                    cmds = []
-                    with lock:
-                        for item in CONTEXT.commands:
-                            cmds.append(item)
-                    if len(cmds) > 0:
-                        _send_lines(connection,
-                                    [event.target],
-                                    "\n".join(cmds))
-                if d == RESTART or d.startswith(RESTART + " "):
-                    log.info("restart requested...")
-                    with lock:
-                        parts = d.split(" ")
-                        if event.target == CONTEXT.hostname or \
-                           (len(parts) > 1 and CONTEXT.name in parts[1:]):
-                                log.info('restart accepted...')
-                                RESET = True
-                if d == KILL:
-                    with lock:
-                        if event.target == CONTEXT.hostname:
-                            log.debug("killed.")
-                            KILLED = True
-                cmd = None
-                subcmd = d.split(" ")
-                if len(subcmd) > 0:
-                    key = subcmd[0]
-                    with lock:
-                        if key in CONTEXT.commands:
-                            cmd = CONTEXT.commands[key]
-                    if cmd is not None:
-                        _proc_cmd(cmd, connection, [event.target], subcmd[1:])
+                if action is not None:
+                    action(connection, event, parts)
+
+
+def _status(connection, event, parts):
+    """Report status."""
+    _reply(connection, event, STATUS, "alive: " + VERS)
+
+
+def _debug(connection, event, parts):
+    """Change debug output."""
+    global HOST
+    global JOINT
+    with lock:
+        msg = "public"
+        if CONTEXT.hostname == event.target:
+            msg = "private"
+            HOST = True
+            JOINT = False
+        elif event.target in CONTEXT.rooms:
+            HOST = True
+            JOINT = True
+    _reply(connection, event, DEBUG, msg)
+
+
+def _help(connection, event, parts):
+    """Report help and the available commands."""
+    cmds = [HELP_TEXT]
+    with lock:
+        for item in CONTEXT.commands:
+            cmds.append(item)
+    _reply(connection, event, HELP, "\n".join(cmds))
+
+
+def _restart(connection, event, parts):
+    """Restart the bot (connection)."""
+    global RESET
+    log.info("restart requested...")
+    with lock:
+        if event.target == CONTEXT.hostname or \
+           (len(parts) > 1 and CONTEXT.name in parts[1:]):
+                log.info('restart accepted...')
+                RESET = True
+    _wake()
+
+
+def _reload_cmd(connection, event, parts):
+    """Reload the config (in place)."""
+    global RELOAD
+    log.info("reload requested...")
+    with lock:
+        if event.target == CONTEXT.hostname or \
+           (len(parts) > 1 and CONTEXT.name in parts[1:]):
+            log.info('reload accepted...')
+            RELOAD = True
+    _wake()
+
+
+def _profile_cmd(connection, event, parts):
+    """Start/stop the profiler."""
+    with lock:
+        accepted = event.target == CONTEXT.hostname or \
+            (len(parts) > 2 and CONTEXT.name in parts[2:])
+    if not accepted:
+        return
+    action = parts[1] if len(parts) > 1 else None
+    if WORKERS is None or \
+       not WORKERS.submit(_profile_reply, connection, event.target, action):
+        _profile_reply(connection, event.target, action)
+
+
+def _profile_reply(connection, target, action):
+    """Start/stop the profiler, the outcome is posted to the target."""
+    _send_lines(connection, [target], _profile(action))
+
+
+def _kill(connection, event, parts):
+    """Kill the bot."""
+    global KILLED
+    with lock:
+        if event.target == CONTEXT.hostname:
+            log.debug("killed.")
+            KILLED = True
+    _wake()
+
+
+def _stats(connection, event, parts):
+    """Report runtime metrics."""
+    _reply(connection, event, STATS, "\n".join(METRICS.lines()))
+
+
+def _command(cmd_obj, connection, event, parts):
+    """Run a configured command/module."""
+    if cmd_obj.is_shell and _aggregating(event.target):
+        connection = Relay(connection, event.target, " ".join(parts))
+    _submit_cmd(cmd_obj, connection, [event.target], parts[1:])
+
+
+_BUILTINS = {}
+_BUILTINS[STATUS] = _status
+_BUILTINS[DEBUG] = _debug
+_BUILTINS[HELP] = _help
+_BUILTINS[RESTART] = _restart
+_BUILTINS[KILL] = _kill
+_BUILTINS[STATS] = _stats
+_BUILTINS[RELOAD_CMD] = _reload_cmd
+_BUILTINS[PROFILE] = _profile_cmd
+
+
+class Dispatch(object):
+    """Precompiled dispatch for builtins, commands and module handlers."""
+
+    def __init__(self, commands):
+        """Init the instance."""
+        self.table = {}
+        self._channels = {}
+        self._any = []
+        for key in commands:
+            cmd_obj = commands[key]
+            if key in _BUILTINS:
+                log.warn("builtin overrides command: " + key)
+            else:
+                self.table[key] = functools.partial(_command, cmd_obj)
+            if cmd_obj.is_shell or not cmd_obj.is_handler:
+                continue
+            entry = (cmd_obj.matcher(), cmd_obj)
+            if cmd_obj.channels is None:
+                self._any.append(entry)
+                continue
+            for channel in cmd_obj.channels:
+                if channel not in self._channels:
+                    self._channels[channel] = []
+                self._channels[channel].append(entry)
+        self.table.update(_BUILTINS)
+
+    def handlers(self, target, text):
+        """Get the module handlers subscribed to a message."""
+        result = []
+        for entries in [self._channels.get(target, []), self._any]:
+            for matcher, cmd_obj in entries:
+                if matcher is None or matcher.search(text):
+                    result.append(cmd_obj)
+        return result
+
 
+class Acl(object):
+    """Compiled hostmask ACL, decisions are cached per source.
 
+    A grant is (commands, channels), None meaning any command/channel.
+    """
+
+    def __init__(self, permitted, rules, cache=1024):
+        """Init the instance."""
+        self._matchers = []
+        self._cache = collections.OrderedDict()
+        self._size = cache
+        self._lock = threading.Lock()
+        # NOTE: permitted entries match anywhere in the source, any command
+        if len(permitted) > 0:
+            pattern = "|".join([re.escape(x) for x in permitted])
+            self._matchers.append((re.compile(pattern).search, (None, None)))
+        grants = collections.OrderedDict()
+        for rule in rules:
+            if not isinstance(rule, dict) or "mask" not in rule:
+                raise SMIRCError("invalid acl rule: " + str(rule))
+            grant = (self._set(rule.get("commands", None), IND),
+                     self._set(rule.get("channels", None), "#"))
+            masks = rule["mask"]
+            if not isinstance(masks, list):
+                masks = [masks]
+            if grant not in grants:
+                grants[grant] = []
+            grants[grant] += [self._mask(x) for x in masks]
+        for grant in grants:
+            pattern = "|".join(["(?:{})".format(fnmatch.translate(x))
+                                for x in grants[grant]])
+            matcher = re.compile(pattern, re.IGNORECASE).match
+            self._matchers.append((matcher, grant))
+
+    def _set(self, names, prefix):
+        """Names of a grant (None for any), prefixed when given without."""
+        if names is None:
+            return None
+        if not isinstance(names, list):
+            names = [names]
+        return frozenset([x if x.startswith(prefix) else prefix + x
+                          for x in names])
+
+    def _mask(self, mask):
+        """Hostmask glob, a bare nick matches any user/host."""
+        if "!" not in mask and "@" not in mask:
+            return mask + "!*@*"
+        return mask
+
+    def grants(self, source):
+        """Get the grants of a source (nick!user@host)."""
+        source = str(source)
+        with self._lock:
+            found = self._cache.get(source, None)
+            if found is not None:
+                self._cache.move_to_end(source)
+                return found
+        found = tuple([grant for matcher, grant in self._matchers
+                       if matcher(source)])
+        with self._lock:
+            self._cache[source] = found
+            if len(self._cache) > self._size:
+                self._cache.popitem(last=False)
+        return found
+
+    @staticmethod
+    def allows(grants, command, channel):
+        """Check any grant allows a command in a channel."""
+        for commands, channels in grants:
+            if commands is not None and command not in commands:
+                continue
+            if channels is not None and channel not in channels:
+                continue
+            return True
+        return False
+
+
+def _submit_cmd(cmd_obj, connection, target, subcmd):
+    """Run a command on the worker pool."""
+    if WORKERS is None:
+        _proc_cmd(cmd_obj, connection, target, subcmd)
+        return
+    if not isinstance(connection, Relay):
+        connection = Proxy(connection)
+    if not WORKERS.submit(_proc_cmd,
+                          cmd_obj,
+                          connection,
+                          target,
+                          subcmd):
+        log.warning("worker pool full")
+        _send_lines(connection, target, "busy, try again shortly")
+        if isinstance(connection, Relay):
+            connection.close()
+
+
+def _module_turn(cmd_obj):
+    """Wait for a module call slot, None when dropped."""
+    turn = Queue()
+    if not cmd_obj.guard.submit(turn.put):
+        return None
+    try:
+        return turn.get(timeout=cmd_obj.guard.limit())
+    except Empty:
+        # NOTE: a hung call gives up its slot (or opens the breaker)
+        cmd_obj.guard.check()
+        if cmd_obj.guard.withdraw(turn.put):
+            log.warning("module {} call dropped: waited too long".format(
+                cmd_obj.name))
+            METRICS.incr("module drops " + cmd_obj.name)
+            return None
+        # NOTE: handed a slot (or dropped) meanwhile
+        return turn.get()
+
+
+@_profiled
 def _proc_cmd(cmd_obj, connection, target, subcmd):
     """Process command."""
+    started = time.monotonic()
+    shared = False
     try:
         if not cmd_obj.is_shell:
-            cmd_obj.module(connection, target, subcmd, log)
+            key = _module_turn(cmd_obj)
+            if key is None:
+                _send_lines(connection,
+                            target,
+                            "{} unavailable, try again later".format(
+                                cmd_obj.name))
+                return
+            error = None
+            try:
+                cmd_obj.module(connection, target, subcmd, log)
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                cmd_obj.guard.leave(key, error)
             return
         cmd = cmd_obj.path
         cmds = []
@@ -170,83 +1103,980 @@ def _proc_cmd(cmd_obj, connection, target, subcmd):
         for item in subcmd:
             cmds.append(item)
         log.debug(cmds)
-        p = subprocess.Popen(cmds,
-                             stderr=subprocess.STDOUT,
-                             stdout=subprocess.PIPE)
-        outs = None
-        errs = None
+        timeout = cmd_obj.timeout
+        if timeout is None:
+            timeout = CONTEXT.command_timeout
+        results = cmd_obj.results
+        key = tuple(cmds)
+        if results is not None:
+            cached, lead = results.join(key, (connection, target))
+            if cached is not None:
+                METRICS.incr("command cached " + cmd_obj.name)
+                _send_lines(connection, target, cached)
+                return
+            if not lead:
+                # NOTE: the lead request replies (and closes any relay)
+                METRICS.incr("command shared " + cmd_obj.name)
+                shared = True
+                return
+        lines = cmd_obj.lines
+        if lines is None:
+            lines = CONTEXT.command_lines
+        size = cmd_obj.bytes
+        if size is None:
+            size = CONTEXT.command_bytes
+        text = None
         try:
-            outs, errs = p.communicate(timeout=60)
-        except TimeoutExpired:
-            proc.kill()
-            outs, errs = p.communicate()
-        out = []
-        if outs is not None:
-            out.append(outs)
-        if errs is not None:
-            out.append(errs)
-            log.debug(out)
-        if len(out) > 0:
-            _send_lines(connection,
-                        target,
-                        "\n".join([x.decode("utf-8") for x in out]))
+            # NOTE: lines go out as the command produces them
+            text = _shell(cmds,
+                          timeout,
+                          emit=functools.partial(_send_lines,
+                                                 connection,
+                                                 target),
+                          lines=lines,
+                          size=size)
+        finally:
+            if results is not None:
+                for waiter in results.land(key, text):
+                    _send_lines(waiter[0],
+                                waiter[1],
+                                text or "unable to execute command")
+                    if isinstance(waiter[0], Relay):
+                        waiter[0].close()
     except Exception as e:
         _send_lines(connection, target, "unable to execute command: " + str(e))
+    finally:
+        METRICS.observe("command " + cmd_obj.name, time.monotonic() - started)
+        if isinstance(connection, Relay) and not shared:
+            connection.close()
+
+
+def _shell(cmds, timeout, emit=None, lines=0, size=0):
+    """Run a shell command, returns its output (and any notices).
+
+    Output is read and decoded as it is produced, lines are handed to emit
+    as they complete. Past lines/size (bytes, 0 for no cap) lines are only
+    counted and a truncation notice is added.
+    """
+    import subprocess
+    p = subprocess.Popen(cmds,
+                         stderr=subprocess.STDOUT,
+                         stdout=subprocess.PIPE)
+    fd = p.stdout.fileno()
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    deadline = time.monotonic() + timeout
+    kept = []
+    count = 0
+    used = 0
+    skipped = 0
+    partial = ""
+    timed_out = False
+    done = False
+    try:
+        while not done:
+            left = deadline - time.monotonic()
+            if left <= 0 or not select.select([fd], [], [], left)[0]:
+                timed_out = True
+                p.kill()
+                break
+            block = os.read(fd, 65536)
+            done = len(block) == 0
+            partial += decoder.decode(block, final=done)
+            parts = partial.split("\n")
+            partial = parts.pop()
+            if len(partial) > 0 and (done or len(partial) > _STREAM_PARTIAL):
+                parts.append(partial)
+                partial = ""
+            batch = []
+            for line in parts:
+                count += 1
+                used += len(line.encode("utf-8")) + 1
+                if skipped > 0 or \
+                   (lines > 0 and count > lines) or \
+                   (size > 0 and used > size):
+                    skipped += 1
+                    continue
+                batch.append(line)
+            if len(batch) > 0:
+                kept += batch
+                if emit is not None:
+                    emit("\n".join(batch))
+    finally:
+        p.stdout.close()
+        # NOTE: the command may close its output and keep running
+        try:
+            p.wait(timeout=max(0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            p.kill()
+            p.wait()
+    notes = []
+    if skipped > 0:
+        notes.append("... {} of {} lines truncated ...".format(skipped,
+                                                               count))
+    if timed_out:
+        notes.append("command timed out after {}s".format(timeout))
+    if len(notes) > 0 and emit is not None:
+        emit("\n".join(notes))
+    return "\n".join(kept + notes)
+
+
+class Results(object):
+    """Command results, cached for a ttl and shared by identical requests."""
+
+    def __init__(self, ttl, size=256):
+        """Init the instance."""
+        self.ttl = ttl
+        self.size = max(1, size)
+        self._done = collections.OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def join(self, key, waiter):
+        """Get a cached result or join the running request for a key.
+
+        Returns (result, lead), result is None on a miss and lead is True
+        when the caller runs the request (and must land it).
+        """
+        now = time.monotonic()
+        with self._lock:
+            while len(self._done) > 0:
+                oldest = next(iter(self._done))
+                if self._done[oldest][0] > now:
+                    break
+                del self._done[oldest]
+            if key in self._done:
+                return (self._done[key][1], False)
+            if key in self._flights:
+                self._flights[key].append(waiter)
+                return (None, False)
+            self._flights[key] = []
+            return (None, True)
+
+    def land(self, key, result):
+        """Finish a request (result None is not cached), returns waiters."""
+        with self._lock:
+            waiters = self._flights.pop(key, [])
+            if result is not None:
+                self._done.pop(key, None)
+                self._done[key] = (time.monotonic() + self.ttl, result)
+                while len(self._done) > self.size:
+                    self._done.popitem(last=False)
+            return waiters
+
+
+class Proxy(object):
+    """Connection proxy routing privmsg through the outbound scheduler."""
+
+    def __init__(self, connection):
+        """Init the instance."""
+        self._connection = connection
+
+    def privmsg(self, target, text):
+        """Send a private message."""
+        _send_lines(self._connection, [target], text)
+
+    def __getattr__(self, name):
+        """Anything else goes to the connection."""
+        return getattr(self._connection, name)
+
+
+def _aggregating(target):
+    """Check replies in a target go through the fleet's aggregator."""
+    with lock:
+        if target != CONTEXT.joint:
+            return False
+        return CONTEXT.aggregate or CONTEXT.aggregator is not None
+
+
+def _reply(connection, event, command, text):
+    """Reply to a builtin command, through the aggregator when configured."""
+    if _aggregating(event.target):
+        relay = Relay(connection, event.target, command)
+        _send_lines(relay, [event.target], text)
+        # NOTE: relaying may wait on the aggregator, not on the bot loop
+        if WORKERS is not None and WORKERS.submit(relay.close):
+            return
+    _send_lines(connection, [event.target], text)
+
+
+class Relay(object):
+    """Connection stand-in collecting a command reply for the aggregator."""
+
+    def __init__(self, connection, channel, command):
+        """Init the instance."""
+        self._connection = connection
+        self._channel = channel
+        self._command = command
+        self._lines = []
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def privmsg(self, target, text):
+        """Collect a line, lines after the reply was relayed are sent."""
+        with self._lock:
+            if not self._closed:
+                self._lines.append(text)
+                return
+        _send_lines(self._connection, [target], text)
+
+    def close(self):
+        """Relay the collected reply."""
+        with self._lock:
+            self._closed = True
+            text = "\n".join(self._lines)
+        if len(text) > 0:
+            _fleet_reply(self._connection, self._channel, self._command, text)
+
+
+def _fleet_reply(connection, channel, command, text):
+    """Hand a reply to the aggregator, posted as-is when it is unreachable."""
+    import zmq
+    with lock:
+        args = CONTEXT
+    if args.aggregate:
+        FLEET.add(channel, command, args.name, text)
+        return
+    message = {}
+    message[_REPLY_TYPE] = {}
+    message[_REPLY_TYPE][_HOST] = args.name
+    message[_REPLY_TYPE][_CHANNEL] = channel
+    message[_REPLY_TYPE][_COMMAND] = command
+    message[_REPLY_TYPE][_DATA] = text
+    socket = None
+    try:
+        socket = _client_socket(args,
+                                endpoint=args.aggregator,
+                                timeout=args.aggregate_window)
+        socket.send_json(message)
+        if args.ingest != _PULL_INGEST:
+            socket.recv()
+        METRICS.incr("fleet relayed")
+        return
+    except zmq.error.ZMQError as e:
+        log.warning("aggregator unreachable")
+        log.warning(e)
+    finally:
+        if socket is not None:
+            # NOTE: lingers (up to the window) for a pushed reply to go out
+            socket.close()
+            socket.context.term()
+    METRICS.incr("fleet fallbacks")
+    _send_lines(connection, [channel], text)
+
+
+class Fleet(object):
+    """Aggregator, merges the fleet's replies to a command into a summary."""
+
+    def __init__(self):
+        """Init the instance."""
+        self.known = set()
+        self._open = {}
+        self._lock = threading.Lock()
+
+    def add(self, channel, command, host, text):
+        """Collect a reply, the first one opens the collection window."""
+        with lock:
+            window = CONTEXT.aggregate_window
+            expected = CONTEXT.fleet
+        with self._lock:
+            self.known.add(host)
+            key = (channel, command)
+            replies = self._open.get(key, None)
+            if replies is None:
+                replies = collections.OrderedDict()
+                self._open[key] = replies
+                timer = threading.Timer(window,
+                                        self._close,
+                                        args=(key, expected))
+                timer.daemon = True
+                timer.start()
+            replies[host] = text
+
+    def _close(self, key, expected):
+        """Post the summary once the collection window closed."""
+        with self._lock:
+            replies = self._open.pop(key)
+            missing = sorted((self.known | set(expected)) - set(replies))
+        METRICS.incr("fleet summaries")
+        _send_lines(None, [key[0]], self.summary(key[1], replies, missing))
+
+    def summary(self, command, replies, missing):
+        """Summarize replies, identical replies are counted together."""
+        groups = collections.OrderedDict()
+        for host in replies:
+            text = " | ".join(replies[host].split("\n"))
+            if text not in groups:
+                groups[text] = []
+            groups[text].append(host)
+        items = []
+        for text in sorted(groups, key=lambda x: -len(groups[x])):
+            hosts = groups[text]
+            item = "{} {}".format(len(hosts), text)
+            if len(hosts) <= _FLEET_NAMES:
+                item += " ({})".format(" ".join(sorted(hosts)))
+            items.append(item)
+        # NOTE: never starts with the command indicator, bots ignore it
+        result = "fleet {}: {}".format(command, ", ".join(items))
+        if len(missing) > 0:
+            result += "\nfleet {}: missing {}".format(
+                command,
+                " ".join(missing))
+        return result
+
+
+FLEET = Fleet()
+
+
+def _collect(reply):
+    """Collect a fleet reply received on the ingest socket."""
+    try:
+        FLEET.add(reply[_CHANNEL],
+                  reply[_COMMAND],
+                  reply[_HOST],
+                  reply[_DATA])
+    except (KeyError, TypeError) as e:
+        log.warning("invalid fleet reply")
+        log.warning(e)
+
+
+class Workers(object):
+    """Bounded worker pool for commands."""
+
+    def __init__(self, size, backlog):
+        """Init the instance."""
+        import concurrent.futures
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=size)
+        self._slots = threading.BoundedSemaphore(size + backlog)
+
+    def submit(self, fn, *args):
+        """Submit work, False when the pool is full."""
+        if not self._slots.acquire(blocking=False):
+            return False
+        future = self._pool.submit(fn, *args)
+        future.add_done_callback(self._done)
+        return True
+
+    def _done(self, future):
+        """Work completed."""
+        self._slots.release()
+        if future.exception() is not None:
+            log.warning("worker error")
+            log.warning(future.exception())
+
+    def shutdown(self):
+        """Stop taking work, running work finishes in the background."""
+        self._pool.shutdown(wait=False)
+
+
+@_profiled
+def on_message(connection, event):
+    """On message received."""
+    global REPORTED_IN
+    do_action = False
+    permitted = ()
+    with lock:
+        if not REPORTED_IN:
+            connection.privmsg(CONTEXT.hostname, "online")
+            REPORTED_IN = True
+        if event.target in [CONTEXT.hostname] + CONTEXT.rooms:
+            do_action = True
+            permitted = CONTEXT.access.grants(event.source)
+    if do_action and event.type == "pubmsg":
+        log.debug(event)
+        text = " ".join(event.arguments)
+        with lock:
+            handlers = CONTEXT.dispatch.handlers(event.target, text)
+        for cmd_obj in handlers:
+            _submit_handle(cmd_obj, connection, event)
+        _act(connection, event, permitted)
+
+
+def _submit_handle(cmd_obj, connection, event):
+    """Run a module handler on the handler pool (outside the lock)."""
+    if HANDLERS is not None:
+        connection = Proxy(connection)
+    cmd_obj.guard.submit(functools.partial(_start_handle,
+                                           cmd_obj,
+                                           connection,
+                                           event))
+
+
+def _start_handle(cmd_obj, connection, event, key):
+    """Start a module handler once it has a call slot (None: dropped)."""
+    if key is None:
+        return
+    if HANDLERS is None:
+        _run_handle(cmd_obj, key, connection, event)
+        return
+    if not HANDLERS.submit(_run_handle,
+                           cmd_obj,
+                           key,
+                           connection,
+                           event):
+        log.warning("handler pool full")
+        METRICS.incr("handler drops")
+        cmd_obj.guard.discard(key)
+
+
+@_profiled
+def _run_handle(cmd_obj, key, connection, event):
+    """Run a module handler, recording the outcome for its guard."""
+    started = time.monotonic()
+    error = None
+    try:
+        cmd_obj.handle(connection, event, log)
+    except Exception as e:
+        error = e
+        log.warning("module handler error")
+        log.warning(e)
+    finally:
+        METRICS.observe("handle " + cmd_obj.name, time.monotonic() - started)
+        cmd_obj.guard.leave(key, error)
+
+
+class Guard(object):
+    """Module isolation, a timeout, a concurrency limit and a breaker.
+
+    Calls beyond the concurrency wait in a bounded backlog (in order), calls
+    past the timeout (still running or not) count as failures and give up
+    their slot, enough consecutive failures open the breaker and calls are
+    dropped until the cooldown passes, then a single failure opens it again.
+    """
+
+    def __init__(self, name, timeout=None, concurrency=1, failures=5,
+                 cooldown=60, backlog=16):
+        """Init the instance."""
+        self.name = name
+        self.timeout = timeout
+        self.concurrency = max(1, concurrency)
+        self.failures = max(1, failures)
+        self.cooldown = cooldown
+        self.backlog = max(0, backlog)
+        self._running = {}
+        self._waiting = collections.deque()
+        self._failed = 0
+        self._opened = None
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def limit(self):
+        """Call timeout in seconds."""
+        if self.timeout is not None:
+            return self.timeout
+        return CONTEXT.module_timeout
+
+    def _fail(self, now, reason):
+        """Record a failure, opening the breaker past the threshold."""
+        self._failed += 1
+        METRICS.incr("module failures " + self.name)
+        if self._failed >= self.failures and self._opened is None:
+            log.warning("module {} disabled for {}s: {}".format(
+                self.name,
+                self.cooldown,
+                reason))
+            METRICS.incr("module trips " + self.name)
+            self._opened = now
+
+    def _hung(self, now):
+        """Fail running calls past the timeout, freeing their slots."""
+        limit = self.limit()
+        for key in [x for x in self._running
+                    if now - self._running[x] > limit]:
+            # NOTE: a hung call may never return, stop waiting on it
+            del self._running[key]
+            self._fail(now, "timed out after {}s".format(limit))
+
+    def check(self):
+        """Fail hung calls, handing their slots to waiting calls."""
+        now = time.monotonic()
+        with self._lock:
+            self._hung(now)
+            started = self._next(now)
+        self._start(started)
+
+    def _is_open(self, now):
+        """Breaker is open (closing it, half-open, past the cooldown)."""
+        if self._opened is None:
+            return False
+        if now - self._opened < self.cooldown:
+            return True
+        # NOTE: half-open, the next failure opens it again
+        self._opened = None
+        self._failed = self.failures - 1
+        log.info("module {} enabled".format(self.name))
+        return False
+
+    def _drop(self, reason):
+        """Count a dropped call."""
+        log.warning("module {} call dropped: {}".format(self.name, reason))
+        METRICS.incr("module drops " + self.name)
+
+    def _take(self, now):
+        """Take a call slot."""
+        self._seq += 1
+        self._running[self._seq] = now
+        return self._seq
+
+    def _next(self, now):
+        """Hand free slots to waiting calls (or drop them, breaker open)."""
+        started = []
+        if self._is_open(now):
+            while len(self._waiting) > 0:
+                self._drop("disabled")
+                started.append((self._waiting.popleft(), None))
+            return started
+        while len(self._waiting) > 0 and \
+                len(self._running) < self.concurrency:
+            started.append((self._waiting.popleft(), self._take(now)))
+        return started
+
+    def _start(self, started):
+        """Start calls handed a slot (outside the lock)."""
+        for work, key in started:
+            work(key)
+
+    def submit(self, work):
+        """Run work(key) now or once a slot frees, False when dropped.
+
+        Waiting calls dropped later (the breaker opened) get work(None).
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._hung(now)
+            started = self._next(now)
+            key = None
+            accepted = True
+            if self._is_open(now):
+                self._drop("disabled")
+                accepted = False
+            elif len(self._running) < self.concurrency:
+                key = self._take(now)
+            elif len(self._waiting) < self.backlog:
+                self._waiting.append(work)
+            else:
+                self._drop("backlog full")
+                accepted = False
+        self._start(started)
+        if key is not None:
+            work(key)
+        return accepted
+
+    def withdraw(self, work):
+        """Remove a waiting call, False when it was already started."""
+        with self._lock:
+            if work not in self._waiting:
+                return False
+            self._waiting.remove(work)
+            return True
+
+    def leave(self, key, error=None):
+        """Release a call slot, recording its outcome."""
+        now = time.monotonic()
+        with self._lock:
+            started = self._running.pop(key, None)
+            if started is None:
+                # NOTE: unknown or already failed as timed out
+                pass
+            elif error is not None:
+                self._fail(now, str(error))
+            elif now - started > self.limit():
+                self._fail(now, "took {:.1f}s".format(now - started))
+            else:
+                self._failed = 0
+            waiting = self._next(now)
+        self._start(waiting)
+
+    def discard(self, key):
+        """Release a call slot that never ran."""
+        with self._lock:
+            self._running.pop(key, None)
+            waiting = self._next(time.monotonic())
+        self._start(waiting)
+
+
+class Spool(object):
+    """Message queue, spilling to disk segments past a memory threshold.
+
+    Messages stay in memory until the threshold is reached, after that
+    (and until the disk is drained, to keep the order) they are appended
+    to segment files that are read back in order and removed once
+    delivered. Without a path the queue is memory only.
+    """
+
+    def __init__(self, path=None, memory=1000, segment=1000):
+        """Init the instance."""
+        self.path = path
+        self.memory = max(1, memory)
+        self.segment = max(1, segment)
+        self._queue = collections.deque()
+        self._segments = collections.deque()
+        self._disk = 0
+        self._next = 0
+        self._writer = None
+        self._written = 0
+        self._reader = None
+        self._lock = threading.Lock()
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            self._recover()
+
+    def __len__(self):
+        """Queued message count."""
+        with self._lock:
+            return len(self._queue) + self._disk
+
+    def _file(self, name):
+        """Spool file path."""
+        if isinstance(name, int):
+            name = "{:012d}{}".format(name, _SPOOL_EXT)
+        return os.path.join(self.path, name)
+
+    def _recover(self):
+        """Pick up messages spooled by a previous run."""
+        head = self._file(_SPOOL_HEAD)
+        if os.path.exists(head):
+            with open(head, "rb") as f:
+                for line in f:
+                    self._queue.append(json.loads(line.decode("utf-8")))
+            os.remove(head)
+        for name in sorted(os.listdir(self.path)):
+            if name.endswith(_SPOOL_EXT):
+                self._segments.append(int(name[:-len(_SPOOL_EXT)]))
+        if len(self._segments) == 0:
+            return
+        self._next = self._segments[-1] + 1
+        offset = 0
+        cursor = self._file(_SPOOL_CURSOR)
+        if os.path.exists(cursor):
+            with open(cursor) as f:
+                parts = f.read().split(" ")
+            if int(parts[0]) == self._segments[0]:
+                offset = int(parts[1])
+        for seg in self._segments:
+            with open(self._file(seg), "rb") as f:
+                self._disk += f.read().count(b"\n")
+        if offset > 0:
+            self._reader = open(self._file(self._segments[0]), "rb")
+            self._disk -= self._reader.read(offset).count(b"\n")
+        log.info("recovered spooled messages: " + str(
+            len(self._queue) + self._disk))
+
+    def put(self, message):
+        """Queue a message."""
+        self.extend([message])
+
+    def extend(self, messages):
+        """Queue messages."""
+        with self._lock:
+            for message in messages:
+                if self.path is None or \
+                   (self._disk == 0 and len(self._queue) < self.memory):
+                    self._queue.append(message)
+                else:
+                    self._spill(message)
+
+    def requeue(self, messages):
+        """Put messages back ahead of everything queued (in order)."""
+        with self._lock:
+            self._queue.extendleft(reversed(messages))
+
+    def _spill(self, message):
+        """Append a message to the newest segment."""
+        if self._writer is None or self._written >= self.segment:
+            if self._writer is not None:
+                self._writer.close()
+            self._segments.append(self._next)
+            self._writer = open(self._file(self._next), "ab")
+            self._written = 0
+            self._next += 1
+        self._writer.write((json.dumps(message) + "\n").encode("utf-8"))
+        self._writer.flush()
+        self._written += 1
+        self._disk += 1
+
+    def get(self):
+        """Take the oldest message, None when empty."""
+        with self._lock:
+            if len(self._queue) == 0 and self._disk > 0:
+                self._refill()
+            if len(self._queue) == 0:
+                return None
+            return self._queue.popleft()
+
+    def _refill(self):
+        """Read spooled messages back into memory."""
+        while self._disk > 0 and len(self._queue) < self.memory:
+            if self._reader is None:
+                seg = self._segments[0]
+                if self._writer is not None and seg == self._segments[-1]:
+                    # NOTE: stop appending to the segment being read
+                    self._writer.close()
+                    self._writer = None
+                self._reader = open(self._file(seg), "rb")
+            line = self._reader.readline()
+            if len(line) == 0:
+                # NOTE: delivered segments are removed (compacted)
+                self._reader.close()
+                self._reader = None
+                os.remove(self._file(self._segments.popleft()))
+                continue
+            self._disk -= 1
+            self._queue.append(json.loads(line.decode("utf-8")))
+        if self._disk == 0 and self._reader is not None:
+            # NOTE: everything spooled has been read back
+            self._reader.close()
+            self._reader = None
+            while len(self._segments) > 0:
+                os.remove(self._file(self._segments.popleft()))
+        self._cursor()
+
+    def _cursor(self):
+        """Record the read position in the oldest segment."""
+        cursor = self._file(_SPOOL_CURSOR)
+        if self._reader is None:
+            if os.path.exists(cursor):
+                os.remove(cursor)
+            return
+        with open(cursor, "w") as f:
+            f.write("{} {}".format(self._segments[0], self._reader.tell()))
+
+    def close(self):
+        """Persist the in-memory messages for the next run."""
+        with self._lock:
+            if self.path is None:
+                return
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            if self._reader is not None:
+                self._cursor()
+                self._reader.close()
+                self._reader = None
+            if len(self._queue) == 0:
+                return
+            head = self._file(_SPOOL_HEAD)
+            with open(head + ".tmp", "wb") as f:
+                for message in self._queue:
+                    f.write((json.dumps(message) + "\n").encode("utf-8"))
+            os.replace(head + ".tmp", head)
+            log.info("spooled messages: " + str(len(self._queue) +
+                                                self._disk))
+            self._queue.clear()
+
+
+class Levels(object):
+    """Multi-level message queue, a spool per priority class."""
+
+    def __init__(self, path=None, memory=1000, segment=1000, share=0.1):
+        """Init the instance."""
+        self._spools = []
+        for name in _PRIORITIES:
+            sub = path
+            # NOTE: normal messages use the spool directory itself
+            if path is not None and name != _NORMAL:
+                sub = os.path.join(path, name)
+            self._spools.append(Spool(sub, memory, segment))
+        self._share = Share(len(_PRIORITIES), share)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Queued message count."""
+        return sum([len(x) for x in self._spools])
+
+    def put(self, message):
+        """Queue a message."""
+        self.extend([message])
+
+    def extend(self, messages):
+        """Queue messages by priority class."""
+        levels = [[] for x in self._spools]
+        for message in messages:
+            levels[_priority(message)].append(message)
+        for idx, items in enumerate(levels):
+            if len(items) > 0:
+                self._spools[idx].extend(items)
+
+    def requeue(self, messages):
+        """Put messages back ahead of their class's queued messages."""
+        levels = [[] for x in self._spools]
+        for message in messages:
+            levels[_priority(message)].append(message)
+        for idx, items in enumerate(levels):
+            if len(items) > 0:
+                self._spools[idx].requeue(items)
+
+    def get(self, levels=None):
+        """Take the next message (of the given levels), None when empty."""
+        with self._lock:
+            waiting = [x for x in range(len(self._spools))
+                       if (levels is None or x in levels) and
+                       len(self._spools[x]) > 0]
+            level = self._share.pick(waiting)
+            if level is None:
+                return None
+            return self._spools[level].get()
+
+    def close(self):
+        """Persist the in-memory messages for the next run."""
+        for spool in self._spools:
+            spool.close()
+
+
+class Chunks(object):
+    """Reassembles (chunked) messages, capping each at head and tail lines.
+
+    Head lines are queued as chunks arrive, the tail is held until the last
+    chunk and anything between is summarized by a line count.
+    """
+
+    def __init__(self, lines=1000, timeout=60, transfers=64):
+        """Init the instance."""
+        self.lines = lines
+        self.tail = max(0, lines) // 2
+        self.head = max(0, lines) - self.tail
+        self.timeout = timeout
+        self.transfers = max(1, transfers)
+        self._open = collections.OrderedDict()
+
+    def _state(self, message):
+        """Create a new transfer state."""
+        obj = {}
+        obj[_TYPE] = message.get(_TYPE, [])
+        obj[_RECV] = message.get(_RECV, None)
+        obj[_PRIORITY] = message.get(_PRIORITY, _NORMAL)
+        obj[_SEQ] = 0
+        obj["stamp"] = time.monotonic()
+        obj["count"] = 0
+        obj["skipped"] = 0
+        obj["tail"] = collections.deque(maxlen=self.tail)
+        return obj
+
+    def _message(self, state, lines):
+        """Queue-able message for lines of a transfer."""
+        obj = {}
+        obj[_TYPE] = state[_TYPE]
+        obj[_DATA] = "\n".join(lines)
+        obj[_RECV] = state[_RECV]
+        obj[_PRIORITY] = state[_PRIORITY]
+        return obj
+
+    def _feed(self, state, data):
+        """Add a transfer's data, returns the messages to queue."""
+        head = []
+        for line in data.split("\n"):
+            if len(line.strip()) == 0:
+                continue
+            state["count"] += 1
+            if self.lines <= 0 or state["count"] <= self.head:
+                head.append(line)
+                continue
+            if len(state["tail"]) == self.tail:
+                state["skipped"] += 1
+            state["tail"].append(line)
+        if len(head) == 0:
+            return []
+        return [self._message(state, head)]
 
+    def _close(self, state, note=""):
+        """Finish a transfer, returns the messages to queue."""
+        lines = []
+        if state["skipped"] > 0:
+            lines.append("... {} of {} lines truncated{} ...".format(
+                state["skipped"],
+                state["count"],
+                note))
+            METRICS.incr("truncated")
+        elif len(note) > 0:
+            lines.append("...{} ...".format(note))
+        lines += list(state["tail"])
+        if len(lines) == 0:
+            return []
+        return [self._message(state, lines)]
 
-def on_message(connection, event):
-    """On message received."""
-    global CONTEXT
-    global REPORTED_IN
-    do_action = False
-    permitted = False
-    with lock:
-        if not REPORTED_IN:
-            connection.privmsg(CONTEXT.hostname, "online")
-            REPORTED_IN = True
-        if event.target in [CONTEXT.hostname] + CONTEXT.rooms:
-            do_action = True
-            for source in CONTEXT.permitted:
-                if source in event.source:
-                    permitted = True
-                    break
-    if do_action and event.type == "pubmsg":
-        log.debug(event)
-        with lock:
-            for item in CONTEXT.commands:
-                cmd_obj = CONTEXT.commands[item]
-                if not cmd_obj.is_shell:
-                    cmd_obj.handle(connection, event, log)
-        _act(connection, event, permitted)
+    def expire(self):
+        """Close stale (abandoned) transfers, returns the messages to queue."""
+        result = []
+        now = time.monotonic()
+        while len(self._open) > 0:
+            key = next(iter(self._open))
+            state = self._open[key]
+            stale = now - state["stamp"] > self.timeout
+            if not stale and len(self._open) <= self.transfers:
+                break
+            del self._open[key]
+            log.warning("incomplete message")
+            result += self._close(state, note=" (incomplete)")
+        return result
+
+    def _check(self, message):
+        """Validate a message's fields, raises ValueError when malformed."""
+        key = message.get(_CHUNK, None)
+        if key is not None and \
+           (isinstance(key, bool) or not isinstance(key, (str, int))):
+            raise ValueError("invalid chunk id: {}".format(key))
+        seq = message.get(_SEQ, 0)
+        if isinstance(seq, bool) or not isinstance(seq, int) or seq < 0:
+            raise ValueError("invalid chunk sequence: {}".format(seq))
+        if not isinstance(message.get(_DATA, ""), str):
+            raise ValueError("invalid data, not a string")
+        to = message.get(_TYPE, [])
+        if not isinstance(to, list) or \
+           not all(isinstance(x, str) for x in to):
+            raise ValueError("invalid types, not a list of strings")
+
+    def add(self, message):
+        """Add a received message, returns the messages to queue."""
+        self._check(message)
+        key = message.get(_CHUNK, None)
+        if key is None:
+            state = self._state(message)
+            parts = self._feed(state, message.get(_DATA, "")) + \
+                self._close(state)
+            if len(parts) == 0:
+                return []
+            # NOTE: a whole message (not a transfer) may be coalesced
+            obj = self._message(state, [x[_DATA] for x in parts])
+            obj[_WHOLE] = True
+            return [obj]
+        state = self._open.pop(key, None)
+        if state is None:
+            state = self._state(message)
+        seq = message.get(_SEQ, state[_SEQ])
+        if seq != state[_SEQ]:
+            log.warning("message chunk out of sequence")
+        state[_SEQ] = seq + 1
+        state["stamp"] = time.monotonic()
+        result = self._feed(state, message.get(_DATA, ""))
+        if message.get(_MORE, False):
+            self._open[key] = state
+        else:
+            result += self._close(state)
+        return result + self.expire()
 
 
 def queue_thread(args, q, ctrl):
     """ZMQ receiving thread."""
+    import zmq
     running = True
+    chunks = Chunks(args.message_lines, args.chunk_timeout)
     while running:
+        sock = None
         try:
-            context = zmq.Context()
-            socket = context.socket(zmq.REP)
-            socket.bind("tcp://*:%s" % args.zmq)
-            socket.RCVTIMEO = args.poll * 1000
+            sock = _bind_ingest(args)
+            poller = zmq.Poller()
+            poller.register(sock, zmq.POLLIN)
             while True:
+                if poller.poll(args.poll * 1000):
+                    q.extend(_drain_ingest(sock, args.ingest, chunks))
+                q.extend(chunks.expire())
                 try:
-                    message = socket.recv_json()
-                    socket.send_string("ack")
-                    log.debug(message)
-                    q.put(message)
-                    time.sleep(args.poll)
-                except zmq.ZMQError as e:
-                    if e.errno == zmq.EAGAIN:
-                        try:
-                            val = ctrl.get(block=False, timeout=args.poll)
-                            # NOTE: only stop for now
-                            running = False
-                            raise SMIRCError("bind reset")
-                        except Empty:
-                            pass
-                    else:
-                        raise SMIRCError(str(z))
+                    val = ctrl.get(block=False)
+                    # NOTE: only stop for now
+                    running = False
+                    raise SMIRCError("bind reset")
+                except Empty:
+                    pass
         except Exception as e:
             log.warning("zmq error")
             log.warning(e)
@@ -255,6 +2085,100 @@ def queue_thread(args, q, ctrl):
                 time.sleep(args.retry)
             else:
                 log.info('stopping...')
+        finally:
+            if sock is not None:
+                sock.close(linger=0)
+
+
+def _bind_ingest(args):
+    """Bind the ZMQ ingest socket."""
+    import zmq
+    if args.ingest not in _INGEST_TYPES:
+        raise SMIRCError("unknown ingest type: " + str(args.ingest))
+    context = zmq.Context.instance()
+    sock = context.socket(getattr(zmq, _INGEST_TYPES[args.ingest]))
+    sock.bind(_endpoint(args, True))
+    return sock
+
+
+def _endpoint(args, bind):
+    """ZMQ endpoint of the bot, the configured one or tcp on the zmq port."""
+    if args.endpoint is not None:
+        return args.endpoint
+    if bind:
+        return "tcp://*:%s" % args.zmq
+    return "tcp://localhost:%s" % args.zmq
+
+
+def _drain_ingest(sock, ingest, chunks):
+    """Drain every waiting ingest message without blocking."""
+    import zmq
+    batch = []
+    while sock.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+        frames = sock.recv_multipart(zmq.NOBLOCK)
+        try:
+            message = json.loads(frames[-1].decode("utf-8"))
+            if not isinstance(message, dict):
+                raise ValueError("not an object")
+        except ValueError as e:
+            log.warning("invalid message")
+            log.warning(e)
+            METRICS.incr("invalid")
+            message = None
+        reply = b"ack"
+        is_stats = message is not None and message.get(_STATS_TYPE)
+        is_profile = message is not None and _PROFILE_TYPE in message
+        if is_stats:
+            reply = json.dumps(METRICS.snapshot()).encode("utf-8")
+        elif is_profile:
+            obj = {}
+            # NOTE: never wait on the report here (the bot's loop)
+            obj[_PROFILE_TYPE] = _profile(message[_PROFILE_TYPE], wait=False)
+            reply = json.dumps(obj).encode("utf-8")
+        elif message is not None and _ID in message:
+            # NOTE: pipelined clients correlate acks by message id
+            ack = {}
+            ack[_ACK] = message[_ID]
+            reply = json.dumps(ack).encode("utf-8")
+        if ingest == _REP_INGEST:
+            sock.send(reply)
+        elif ingest == _ROUTER_INGEST:
+            # NOTE: envelope (identity + delimiter) then the payload
+            sock.send_multipart(frames[:-1] + [reply])
+        if message is None or is_stats or is_profile:
+            continue
+        if _REPLY_TYPE in message:
+            _collect(message[_REPLY_TYPE])
+            continue
+        log.debug(message)
+        message[_RECV] = time.time()
+        try:
+            batch += chunks.add(message)
+        except ValueError as e:
+            # NOTE: drop it, like bad json, and keep draining
+            log.warning("invalid message")
+            log.warning(e)
+            METRICS.incr("invalid")
+            continue
+        METRICS.incr("ingested")
+    return batch
+
+
+def _aio_ingest(args, sock, q, wake, chunks):
+    """Ingest socket is readable (event-driven loop)."""
+    batch = _drain_ingest(sock, args.ingest, chunks)
+    if len(batch) > 0:
+        q.extend(batch)
+        wake.set()
+
+
+def _aio_expire(args, loop, q, wake, chunks):
+    """Close stale chunked transfers (periodic, event-driven loop)."""
+    batch = chunks.expire()
+    if len(batch) > 0:
+        q.extend(batch)
+        wake.set()
+    loop.call_later(args.poll, _aio_expire, args, loop, q, wake, chunks)
 
 
 class Ctx(object):
@@ -263,8 +2187,48 @@ class Ctx(object):
     def __init__(self):
         """Init the instance."""
         self.retry = 10
+        self.retry_max = 300
         self.poll = 3
         self.send = 60
+        self.ping = 60
+        self.ping_timeout = 180
+        self.mode = _AIO_MODE
+        self.flood_rate = 1
+        self.flood_burst = 5
+        self.coalesce = 0
+        self.coalesce_cache = 1024
+        self.spool = None
+        self.spool_memory = 1000
+        self.spool_segment = 1000
+        self.outbound_max = 1000
+        self.message_lines = 1000
+        self.chunk_size = 65536
+        self.chunk_timeout = 60
+        self.pool = 1
+        self.workers = 4
+        self.worker_backlog = 16
+        self.command_timeout = 60
+        self.command_lines = 1000
+        self.command_bytes = 65536
+        self.module_workers = 4
+        self.module_backlog = 64
+        self.module_timeout = 10
+        self.stream_lines = 20
+        self.stream_window = 1
+        self.ingest = _ROUTER_INGEST
+        self.endpoint = None
+        self.aggregate = False
+        self.aggregator = None
+        self.aggregate_window = 5
+        self.fleet = []
+        self.acl = []
+        self.acl_cache = 1024
+        self.priority = _NORMAL
+        self.priority_share = 0.1
+        self.profile_dir = None
+        self.profile_interval = 0.01
+        self.profile_limit = 300
+        self.profile_top = 25
         self.joint = "#fragmented"
         self.rooms = []
 
@@ -274,8 +2238,26 @@ def run(config=None,
         private=None,
         to=None,
         bot=None,
-        arguments=None):
+        arguments=None,
+        priority=None):
     """Run smirc command(s)."""
+    _run(_argv(config=config,
+               public=public,
+               private=private,
+               to=to,
+               bot=bot,
+               arguments=arguments,
+               priority=priority), False)
+
+
+def _argv(config=None,
+          public=None,
+          private=None,
+          to=None,
+          bot=None,
+          arguments=None,
+          priority=None):
+    """Command line arguments for the run()/Client options."""
     args = []
     inputs = {}
     inputs[_CONFIG_FLAG] = config
@@ -283,15 +2265,192 @@ def run(config=None,
     inputs[_PUBLIC_FLAG] = public
     inputs[_TO_FLAG] = to
     inputs[_BOT_FLAG] = bot
+    inputs[_PRIORITY_FLAG] = priority
     for k in inputs:
         val = inputs[k]
-        if val is not None:
+        if val is True:
+            args.append(k)
+        elif val is not None:
             args.append(k)
             args.append(val)
     if arguments is not None:
         for a in arguments:
             args.append(a)
-    _run(args, False)
+    return args
+
+
+class Client(object):
+    """Reusable client, the config is loaded once and one socket is kept.
+
+    send() does not wait on the bot (messages are pipelined), the bot acks
+    each message by id and wait() collects the acks. Nothing is acked over
+    pull ingest.
+    """
+
+    def __init__(self,
+                 config=None,
+                 public=None,
+                 private=None,
+                 to=None,
+                 priority=None,
+                 arguments=None):
+        """Init the instance."""
+        import zmq
+        self.args = client_args(_argv(config=config,
+                                      public=public,
+                                      private=private,
+                                      to=to,
+                                      arguments=arguments,
+                                      priority=priority))[0]
+        self._acked = self.args.ingest != _PULL_INGEST
+        self._context = self._new_context()
+        self._socket = self._context.socket(zmq.DEALER if self._acked
+                                            else zmq.PUSH)
+        linger = int(self.args.send * 1000)
+        self._socket.SNDTIMEO = linger
+        self._socket.setsockopt(zmq.LINGER, linger)
+        self._socket.connect(_endpoint(self.args, False))
+        self._next = 0
+        self._pending = set()
+
+    def _new_context(self):
+        """ZMQ context of the client."""
+        import zmq
+        return zmq.Context()
+
+    def __enter__(self):
+        """Enter the client context."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Close the client."""
+        self.close()
+
+    def _frames(self, datum, priority):
+        """Message frames to send, returns (id, frames)."""
+        message = _client_message(self.args, datum)
+        if priority is not None:
+            if priority not in _PRIORITIES:
+                raise SMIRCError("unknown priority: " + str(priority))
+            message[_PRIORITY] = priority
+        self._next += 1
+        message[_ID] = self._next
+        frames = [json.dumps(message).encode("utf-8")]
+        if self._acked:
+            # NOTE: empty delimiter, the envelope REP/ROUTER expect
+            frames.insert(0, b"")
+        return (self._next, frames)
+
+    def _ack(self, frames):
+        """Record an ack."""
+        try:
+            ack = json.loads(frames[-1].decode("utf-8"))
+            self._pending.discard(ack[_ACK])
+        except (ValueError, KeyError, TypeError) as e:
+            log.warning("invalid ack")
+            log.warning(e)
+
+    def _sent(self, key):
+        """Track a sent message."""
+        if self._acked:
+            self._pending.add(key)
+
+    def pending(self):
+        """Ids of the messages sent but not acked yet."""
+        return sorted(self._pending)
+
+    def _deadline(self, timeout):
+        """Deadline of a wait."""
+        if timeout is None:
+            timeout = self.args.send
+        return time.monotonic() + timeout
+
+    def _receive(self, timeout):
+        """Collect acks, waiting up to timeout (ms) for the first one."""
+        import zmq
+        while self._socket.poll(timeout, zmq.POLLIN):
+            self._ack(self._socket.recv_multipart())
+            timeout = 0
+
+    def send(self, datum, priority=None):
+        """Send a message without waiting, returns its id (None on error)."""
+        import zmq
+        key, frames = self._frames(datum, priority)
+        try:
+            self._socket.send_multipart(frames)
+        except zmq.error.Again as z:
+            log.warning("sending error")
+            log.warning(z)
+            return None
+        self._sent(key)
+        # NOTE: take waiting acks so they never pile up in the socket
+        if self._acked:
+            self._receive(0)
+        return key
+
+    def send_many(self, data, priority=None):
+        """Send messages without waiting, returns their ids."""
+        return [self.send(x, priority=priority) for x in data]
+
+    def wait(self, timeout=None):
+        """Wait for the acks of everything sent, True once all arrived."""
+        deadline = self._deadline(timeout)
+        while len(self._pending) > 0:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return False
+            self._receive(int(left * 1000))
+        return True
+
+    def close(self):
+        """Close the socket (sent messages still go out, up to linger)."""
+        self._socket.close()
+        self._context.term()
+
+
+class AioClient(Client):
+    """Client for asyncio code, send/send_many/wait are coroutines."""
+
+    def _new_context(self):
+        """ZMQ (asyncio) context of the client."""
+        import zmq.asyncio
+        return zmq.asyncio.Context()
+
+    async def _receive(self, timeout):
+        """Collect acks, waiting up to timeout (ms) for the first one."""
+        import zmq
+        while await self._socket.poll(timeout, zmq.POLLIN):
+            self._ack(await self._socket.recv_multipart())
+            timeout = 0
+
+    async def send(self, datum, priority=None):
+        """Send a message without waiting, returns its id (None on error)."""
+        import zmq
+        key, frames = self._frames(datum, priority)
+        try:
+            await self._socket.send_multipart(frames)
+        except zmq.error.Again as z:
+            log.warning("sending error")
+            log.warning(z)
+            return None
+        self._sent(key)
+        if self._acked:
+            await self._receive(0)
+        return key
+
+    async def send_many(self, data, priority=None):
+        """Send messages without waiting, returns their ids."""
+        return [await self.send(x, priority=priority) for x in data]
+
+    async def wait(self, timeout=None):
+        """Wait for the acks of everything sent, True once all arrived."""
+        deadline = self._deadline(timeout)
+        while len(self._pending) > 0:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return False
+            await self._receive(int(left * 1000))
+        return True
 
 
 class SMIRCError(Exception):
@@ -309,8 +2468,8 @@ def _handle_app(is_app, message, code):
         raise SMIRCError("{} -> {}".format(message, code))
 
 
-def get_args(arguments=None, is_app=False):
-    """Get the arguments."""
+def _parser():
+    """Command line parser."""
     parser = argparse.ArgumentParser()
     parser.add_argument(_CONFIG_FLAG,
                         type=str,
@@ -320,10 +2479,23 @@ def get_args(arguments=None, is_app=False):
     parser.add_argument(_TO_FLAG, type=str)
     parser.add_argument(_BOT_FLAG,
                         action="store_true")
-    args, unknown = parser.parse_known_args(args=arguments)
+    parser.add_argument(_STREAM_FLAG,
+                        action="store_true")
+    parser.add_argument(_STATS_FLAG,
+                        action="store_true")
+    parser.add_argument(_PRIORITY_FLAG,
+                        type=str,
+                        choices=_PRIORITIES)
+    parser.add_argument(_PROFILE_FLAG,
+                        type=str,
+                        choices=[_PROFILE_START, _PROFILE_STOP])
+    return parser
+
+
+def _context(args, is_app, commands, previous=None):
+    """Load the context for parsed args (commands=None skips commands)."""
     do_public = True
     do_private = True
-    log.info(VERS)
     if args.public or args.private or args.to is not None and len(args.to) > 0:
         do_public = args.public
         do_private = args.private
@@ -331,21 +2503,48 @@ def get_args(arguments=None, is_app=False):
         _handle_app(is_app, "no config file exists", 1)
     obj = Ctx()
     setattr(obj, "bot", args.bot)
-    host = socket.gethostname()
-    setattr(obj, "hostname", "#" + host)
-    setattr(obj, "name", host + "-bot")
+    setattr(obj, "stream", args.stream)
+    setattr(obj, "stats", args.stats)
+    setattr(obj, "profile", args.profile)
     setattr(obj, "private", do_private)
     setattr(obj, "public", do_public)
     setattr(obj, "to", args.to)
-    setattr(obj, "permitted", [""])
-    commands = {}
-    load_config_context(obj, args.config, commands)
+    setattr(obj, "permitted", None)
+    load_config_context(obj, args.config, commands, previous)
     local_cfg = args.config + ".local"
     if os.path.exists(local_cfg):
-        log.info('loading local config')
-        log.debug(local_cfg)
-        load_config_context(obj, local_cfg, commands)
+        if commands is not None:
+            log.info('loading local config')
+            log.debug(local_cfg)
+        load_config_context(obj, local_cfg, commands, previous)
+    if args.priority is not None:
+        obj.priority = args.priority
+    if obj.permitted is None:
+        # NOTE: everyone is permitted unless acl rules are configured
+        obj.permitted = [] if len(obj.acl) > 0 else [""]
+    return obj
+
+
+def client_args(arguments=None, is_app=False):
+    """Get the client arguments (no commands/modules are loaded)."""
+    args, unknown = _parser().parse_known_args(args=arguments)
+    return (_context(args, is_app, None), unknown)
+
+
+def get_args(arguments=None, is_app=False, previous=None):
+    """Get the arguments (previous commands are kept when unchanged)."""
+    import socket
+    args, unknown = _parser().parse_known_args(args=arguments)
+    log.info(VERS)
+    commands = {}
+    obj = _context(args, is_app, commands, previous)
+    host = socket.gethostname()
+    setattr(obj, "arguments", arguments)
+    setattr(obj, "hostname", "#" + host)
+    setattr(obj, "name", host + "-bot")
     setattr(obj, "commands", commands)
+    setattr(obj, "dispatch", Dispatch(commands))
+    setattr(obj, "access", Acl(obj.permitted, obj.acl, obj.acl_cache))
     log.info(commands.keys())
     log.debug(commands)
     if obj.rooms is None or \
@@ -358,23 +2557,97 @@ def get_args(arguments=None, is_app=False):
 class Command(object):
     """Command objects."""
 
-    def __init__(self, is_shell, path):
+    def __init__(self, is_shell, path, name=None):
         """Init a command instance."""
+        opts = {}
+        if isinstance(path, dict):
+            opts = path
+            path = opts["path"]
         self.is_shell = is_shell
         self.path = path
+        self.definition = json.dumps(opts if len(opts) > 0 else path,
+                                     sort_keys=True)
+        self.stamp = None
+        self.name = name if name is not None else os.path.basename(path)
+        self.timeout = opts.get("timeout", None)
+        self.lines = opts.get("lines", None)
+        self.bytes = opts.get("bytes", None)
+        self.guard = None
+        self.results = None
+        if opts.get("ttl", 0) > 0:
+            self.results = Results(opts["ttl"])
+        self.channels = None
+        self.prefixes = None
+        self.patterns = None
         self._mod = None
         self._is_handle = False
         self._is_execute = False
         if not self.is_shell:
+            self.stamp = self._stamp()
             self._mod = self._load_mod()
             avail = [x for x in dir(self._mod) if not x.startswith("_")]
             self._is_handle = "handle" in avail
             self._is_execute = "execute" in avail
             if not self._is_handle and not self._is_execute:
                 log.warn("module handler has not actions")
+            self.guard = Guard(self.name,
+                               timeout=self.timeout,
+                               concurrency=opts.get("concurrency", 1),
+                               failures=opts.get("failures", 5),
+                               cooldown=opts.get("cooldown", 60),
+                               backlog=opts.get("backlog", 16))
+            self.channels = getattr(self._mod, "channels", None)
+            self.prefixes = getattr(self._mod, "prefixes", None)
+            self.patterns = getattr(self._mod, "patterns", None)
+
+    @property
+    def is_handler(self):
+        """Module handles messages."""
+        return self._is_handle
+
+    def matcher(self):
+        """Compile the declared prefixes/patterns (None matches all)."""
+        parts = []
+        if self.prefixes is not None:
+            parts += ["^" + re.escape(x) for x in self.prefixes]
+        if self.patterns is not None:
+            parts += ["(?:{})".format(x) for x in self.patterns]
+        if self.prefixes is None and self.patterns is None:
+            return None
+        if len(parts) == 0:
+            # NOTE: declared, but empty, subscriptions match nothing
+            return re.compile("(?!)")
+        return re.compile("|".join(parts))
+
+    def _stamp(self):
+        """Get the module file (mtime, digest)."""
+        import hashlib
+        with open(self.path, "rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        return (os.path.getmtime(self.path), digest)
+
+    def same(self, is_shell, path):
+        """Check a definition (and its module file) is unchanged."""
+        definition = json.dumps(path, sort_keys=True)
+        if is_shell != self.is_shell or definition != self.definition:
+            return False
+        if self.is_shell:
+            return True
+        try:
+            if os.path.getmtime(self.path) == self.stamp[0]:
+                return True
+            stamp = self._stamp()
+        except OSError:
+            return False
+        # NOTE: touched, but not changed
+        if stamp[1] == self.stamp[1]:
+            self.stamp = stamp
+            return True
+        return False
 
     def _load_mod(self):
         """Module loading/import for commands."""
+        import importlib.util
         spec = importlib.util.spec_from_file_location("smirc.mod", self.path)
         mod = importlib.util.module_from_spec(spec)
         spec.loader.exec_module(mod)
@@ -391,66 +2664,314 @@ class Command(object):
             self._mod.execute(connection, target, subcmds, log)
 
 
-def load_config_context(obj, file_name, commands):
+def load_config_context(obj, file_name, commands, previous=None):
     """Load a config context into the object."""
     with open(file_name) as f:
         cfg = json.loads(f.read())
         for k in cfg.keys():
             if k in [_CMD_TYPE, _MOD_TYPE]:
+                if commands is None:
+                    continue
                 sub = cfg[k]
                 for sub_key in sub.keys():
                     use_key = IND + sub_key
                     if use_key in commands:
                         log.warn("overwriting defined command: " + use_key)
+                    prior = None
+                    if previous is not None:
+                        prior = previous.get(use_key, None)
+                    if prior is not None and prior.same(k == _CMD_TYPE,
+                                                        sub[sub_key]):
+                        commands[use_key] = prior
+                        continue
                     commands[use_key] = Command(k == _CMD_TYPE,
-                                                sub[sub_key])
+                                                sub[sub_key],
+                                                name=sub_key)
             else:
                 setattr(obj, k, cfg[k])
 
 
-def sending(args, data):
-    """Sending a message/client."""
+def _client_socket(args, endpoint=None, timeout=None):
+    """Connect a client socket to the bot (or another endpoint)."""
+    import zmq
     context = zmq.Context()
-    socket = context.socket(zmq.REQ)
-    socket.connect("tcp://localhost:%s" % args.zmq)
-    lines = data
-    if lines is None or len(lines) == 0:
-        lines = sys.stdin.readlines()
-    datum = "".join(lines)
-    linger = args.send * 1000
+    push = args.ingest == _PULL_INGEST
+    socket = context.socket(zmq.PUSH if push else zmq.REQ)
+    linger = int((timeout or args.send) * 1000)
     socket.RCVTIMEO = linger
-    result = False
+    socket.SNDTIMEO = linger
     socket.setsockopt(zmq.LINGER, linger)
+    if not push:
+        # NOTE: allow another request after a timed out ack
+        socket.setsockopt(zmq.REQ_RELAXED, 1)
+        socket.setsockopt(zmq.REQ_CORRELATE, 1)
+    socket.connect(endpoint or _endpoint(args, False))
+    return socket
+
+
+def _client_types(args):
+    """Message types (targets) for the client args."""
+    obj = []
+    if args.public:
+        obj.append(_PUB_TYPE)
+    if args.private:
+        obj.append(_PRIV_TYPE)
+    if args.to is not None and len(args.to) > 0:
+        if args.public and args.to:
+            log.info("public overrides --to")
+        else:
+            obj.append(args.to)
+    return obj
+
+
+def _client_message(args, datum, chunk=None):
+    """Message (json object) for data sent to the bot.
+
+    chunk is (transfer id, sequence, more) for a chunk of a large message.
+    """
+    send_data = {}
+    send_data[_TYPE] = _client_types(args)
+    send_data[_DATA] = datum
+    if args.priority != _NORMAL:
+        send_data[_PRIORITY] = args.priority
+    if chunk is not None:
+        send_data[_CHUNK] = chunk[0]
+        send_data[_SEQ] = chunk[1]
+        send_data[_MORE] = chunk[2]
+    return send_data
+
+
+def _client_send(socket, args, datum, chunk=None):
+    """Send data to the bot, True once it is accepted."""
+    import zmq
+    send_data = _client_message(args, datum, chunk=chunk)
+    try:
+        socket.send_json(send_data)
+        if args.ingest != _PULL_INGEST:
+            ack = socket.recv()
+            log.debug(ack)
+        return True
+    except zmq.error.Again as z:
+        log.warning("sending error")
+        log.warning(z)
+    return False
+
+
+def _read_blocks(stream, size):
+    """Read a stream as decoded text blocks, (block, done) pairs."""
+    try:
+        fd = stream.fileno()
+    except (AttributeError, OSError, ValueError):
+        # NOTE: a file-like without a descriptor is read whole
+        text = "".join(stream.readlines())
+        for idx in range(0, len(text), size):
+            yield (text[idx:idx + size], False)
+        yield ("", True)
+        return
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    done = False
+    while not done:
+        block = os.read(fd, size)
+        done = len(block) == 0
+        yield (decoder.decode(block, final=done), done)
+
+
+def sending(args, data, stream=None):
+    """Sending a message/client, large input is sent in chunks."""
+    socket = _client_socket(args)
+    if data is not None and len(data) > 0:
+        return _client_send(socket, args, "".join(data))
+    if stream is None:
+        stream = sys.stdin
+    key = None
+    seq = 0
+    text = ""
+    for block, done in _read_blocks(stream, args.chunk_size):
+        text += block
+        if len(text) < args.chunk_size and not done:
+            continue
+        datum = text
+        if not done:
+            # NOTE: chunks end on a line, unless a line spans the chunk
+            cut = text.rfind("\n") + 1
+            if cut > 0:
+                datum = text[:cut]
+        text = text[len(datum):]
+        if key is None:
+            if done:
+                return _client_send(socket, args, datum)
+            key = binascii.hexlify(os.urandom(8)).decode("utf-8")
+        if not _client_send(socket, args, datum, chunk=(key, seq, not done)):
+            return False
+        seq += 1
+    return True
+
+
+def stats(args):
+    """Query the bot's runtime metrics (None when unavailable)."""
+    import zmq
+    if args.ingest == _PULL_INGEST:
+        log.warning("stats are unavailable over pull ingest")
+        return None
+    socket = _client_socket(args)
+    send_data = {}
+    send_data[_STATS_TYPE] = True
+    try:
+        socket.send_json(send_data)
+        return json.loads(socket.recv().decode("utf-8"))
+    except zmq.error.Again as z:
+        log.warning("sending error")
+        log.warning(z)
+    return None
+
+
+def profile(args):
+    """Start/stop the bot's profiler, returns the outcome (None on error)."""
+    import zmq
+    if args.ingest == _PULL_INGEST:
+        log.warning("profiling is unavailable over pull ingest")
+        return None
+    socket = _client_socket(args)
+    send_data = {}
+    send_data[_PROFILE_TYPE] = args.profile
     try:
-        obj = []
-        if args.public:
-            obj.append(_PUB_TYPE)
-        if args.private:
-            obj.append(_PRIV_TYPE)
-        if args.to is not None and len(args.to) > 0:
-            if args.public and args.to:
-                log.info("public overrides --to")
-            else:
-                obj.append(args.to)
-        send_data = {}
-        send_data[_TYPE] = obj
-        send_data[_DATA] = datum
         socket.send_json(send_data)
-        ack = socket.recv()
-        log.debug(ack)
-        result = True
+        return json.loads(socket.recv().decode("utf-8"))[_PROFILE_TYPE]
     except zmq.error.Again as z:
         log.warning("sending error")
         log.warning(z)
+    return None
+
+
+def streaming(args, stream=None):
+    """Stream input lines to the bot as they are produced."""
+    if stream is None:
+        stream = sys.stdin
+    fd = stream.fileno()
+    socket = _client_socket(args)
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    result = True
+    lines = []
+    partial = ""
+    flush_at = None
+    done = False
+    while not done:
+        timeout = None
+        if flush_at is not None:
+            timeout = max(0, flush_at - time.monotonic())
+        if select.select([fd], [], [], timeout)[0]:
+            chunk = os.read(fd, 65536)
+            done = len(chunk) == 0
+            partial += decoder.decode(chunk, final=done)
+            parts = partial.split("\n")
+            partial = parts.pop()
+            if len(partial) > 0 and (done or len(partial) > _STREAM_PARTIAL):
+                parts.append(partial)
+                partial = ""
+            if len(lines) == 0 and len(parts) > 0:
+                flush_at = time.monotonic() + args.stream_window
+            lines += parts
+            if len(lines) < args.stream_lines and not done:
+                continue
+        while len(lines) > 0:
+            datum = "\n".join(lines[:args.stream_lines])
+            lines = lines[args.stream_lines:]
+            if not _client_send(socket, args, datum):
+                result = False
+        flush_at = None
     return result
 
 
+def _on_hup(signum, frame):
+    """Reload the config (in place) on SIGHUP."""
+    global RELOAD
+    log.info("reload requested...")
+    with lock:
+        RELOAD = True
+    _wake()
+
+
+def _reloading():
+    """Take a pending reload request."""
+    global RELOAD
+    with lock:
+        reload = RELOAD
+        RELOAD = False
+    return reload
+
+
+def _reload(conns):
+    """Reload the config and changed modules in place (returns a summary).
+
+    Unchanged modules are kept (with their state), settings that need a
+    restart keep their current value and the context is updated in one step.
+    """
+    with lock:
+        args = CONTEXT
+    try:
+        obj = get_args(arguments=args.arguments, previous=args.commands)[0]
+    except Exception as e:
+        log.warning("reload failed")
+        log.warning(e)
+        return "reload failed: {}".format(e)
+    changed = []
+    pending = []
+    with lock:
+        for k, v in vars(obj).items():
+            if k in ["commands", "dispatch", "access"] or \
+               getattr(args, k, None) == v:
+                continue
+            if k in _RESTART_KEYS:
+                pending.append(k)
+                setattr(obj, k, getattr(args, k, None))
+            else:
+                changed.append(k)
+        for k in obj.commands:
+            if obj.commands[k] is not args.commands.get(k, None):
+                changed.append(k)
+        for k in args.commands:
+            if k not in obj.commands:
+                changed.append(k)
+        joins = [x for x in obj.rooms if x not in args.rooms]
+        parts = [x for x in args.rooms if x not in obj.rooms]
+        # NOTE: in place, the loops hold on to this object
+        vars(args).update(vars(obj))
+        if OUTBOUND is not None:
+            OUTBOUND.tune(args.flood_rate,
+                          args.flood_burst,
+                          args.coalesce,
+                          args.coalesce_cache)
+        for c in conns:
+            for room in joins:
+                c.join(room)
+            for room in parts:
+                c.part(room)
+    summary = "reloaded, changed: {}".format(" ".join(sorted(changed)) or
+                                             "nothing")
+    if len(pending) > 0:
+        summary += ", restart needed for: " + " ".join(sorted(pending))
+    log.info(summary)
+    METRICS.incr("reloads")
+    if len(conns) > 0:
+        _send_lines(conns[0], [args.hostname], summary)
+    return summary
+
+
+def _on_term(signum, frame):
+    """Stop the bot (gracefully) on SIGTERM."""
+    global KILLED
+    log.info("terminating...")
+    with lock:
+        KILLED = True
+    _wake()
+
+
 def on_pong(connection, event):
     """PONG received."""
     log.debug(event)
     global LAST_PONG
     with lock:
-        LAST_PONG = 0
+        LAST_PONG = time.monotonic()
 
 
 def main():
@@ -466,19 +2987,67 @@ def _run(args, is_app):
     global LAST_PONG
     global RETRIES
     global KILLED
-    parsed = get_args(arguments=args, is_app=is_app)
+    global OUTBOUND
+    global WORKERS
+    global HANDLERS
+    arguments = args
+    parsed = client_args(arguments=arguments, is_app=is_app)
     args = parsed[0]
-    with lock:
-        CONTEXT = args
     if not args.bot:
-        log.info("client")
+        with lock:
+            CONTEXT = args
         code = 0
-        if not sending(args, parsed[1]):
+        if args.stats:
+            obj = stats(args)
+            if obj is None:
+                code = 1
+            else:
+                print(json.dumps(obj, indent=4, sort_keys=True))
+        elif args.profile is not None:
+            text = profile(args)
+            if text is None:
+                code = 1
+            else:
+                print(text)
+        elif args.stream:
+            if not streaming(args):
+                code = 1
+        elif not sending(args, parsed[1]):
             code = 1
         return _handle_app(is_app, "client executed", code)
+    import signal
+    import ssl
+    from multiprocessing import Queue
+    import irc.connection as conn
+    import irc.client as client
+    parsed = get_args(arguments=arguments, is_app=is_app)
+    args = parsed[0]
+    with lock:
+        CONTEXT = args
     if args.server == "example.com":
         _handle_app(is_app, "default/example server detected...exiting...", 1)
-    q = Queue()
+    signal.signal(signal.SIGTERM, _on_term)
+    signal.signal(signal.SIGHUP, _on_hup)
+    with lock:
+        OUTBOUND = Outbound(args.flood_rate,
+                            args.flood_burst,
+                            coalesce=args.coalesce,
+                            cache=args.coalesce_cache,
+                            share=args.priority_share)
+        WORKERS = Workers(args.workers, args.worker_backlog)
+        HANDLERS = Workers(args.module_workers, args.module_backlog)
+    if args.mode == _AIO_MODE:
+        if _has_aio():
+            return _aio_run(args, is_app)
+        log.warning("asyncio irc client unavailable, using reactor")
+    if args.pool > 1:
+        log.warning("a connection pool needs the async mode, using one")
+    q = Levels(args.spool,
+               args.spool_memory,
+               args.spool_segment,
+               args.priority_share)
+    METRICS.gauge("queued", q.__len__)
+    METRICS.gauge("outbound", OUTBOUND.pending)
     ctrl = Queue()
     background_thread = threading.Thread(target=queue_thread, args=(args,
                                                                     q,
@@ -487,7 +3056,11 @@ def _run(args, is_app):
     while True:
         c = None
         with lock:
+            if KILLED:
+                _stop_reactor(is_app, ctrl, background_thread, q)
+            READY = False
             RESET = False
+            LAST_PONG = time.monotonic()
         try:
             factory = conn.Factory(wrapper=ssl.wrap_socket)
             react = client.Reactor()
@@ -500,43 +3073,40 @@ def _run(args, is_app):
             c.add_global_handler("welcome", on_connect)
             c.add_global_handler("pubmsg", on_message)
             c.add_global_handler("pong", on_pong)
-            do_ping = 0
+            c.add_global_handler("disconnect", on_disconnect)
+            ping_at = time.monotonic() + args.ping
+            pinged = None
             while True:
                 react.process_once(timeout=args.poll)
+                if _reloading():
+                    _reload([c])
                 with lock:
                     if KILLED:
-                        ctrl.put(_STOP)
-                        _handle_app(is_app, "kill kill kill", 1)
+                        _stop_reactor(is_app, ctrl, background_thread, q)
                     if READY:
-                        try:
-                            val = q.get(block=False, timeout=args.poll)
-                            targets = []
-                            to = val[_TYPE]
-                            if JOINT:
-                                for item in args.rooms:
-                                    if _PUB_TYPE in to:
-                                        targets.append(item)
-                                    elif item in to:
-                                        targets.append(item)
-                            if HOST and _PRIV_TYPE in to:
-                                targets.append(args.hostname)
-                            if len(targets) == 0:
-                                log.warn("no targets for message")
-                            _send_lines(c, targets, val[_DATA])
-                        except Empty:
-                            pass
+                        while True:
+                            val = q.get(OUTBOUND.room(args.outbound_max))
+                            if val is None:
+                                break
+                            _send_lines(c,
+                                        _targets(args, val),
+                                        val[_DATA],
+                                        stamp=val.get(_RECV),
+                                        priority=_priority(val),
+                                        coalesce=val.get(_WHOLE, False))
+                        OUTBOUND.flush(c)
                     if RESET:
                         raise SMIRCError("resetting...")
-                    if LAST_PONG > 10:
-                        LAST_PONG = 0
+                    if time.monotonic() - LAST_PONG > args.ping_timeout:
                         raise SMIRCError("no recent pongs...")
                 time.sleep(args.poll)
-                do_ping += 1
-                if do_ping > 10:
-                    do_ping = 0
-                    c.ping(args.hostname)
+                if time.monotonic() >= ping_at:
                     with lock:
-                        LAST_PONG += 1
+                        if pinged is not None and LAST_PONG < pinged:
+                            METRICS.incr("pong_misses")
+                    pinged = time.monotonic()
+                    ping_at = pinged + args.ping
+                    c.ping(args.hostname)
         except Exception as e:
             log.warning(e)
             log.warning("will retry shortly")
@@ -545,19 +3115,403 @@ def _run(args, is_app):
                 c.disconnect("reconnecting...")
             except:
                 pass
-        kill = False
         with lock:
-            kill = RETRIES > 3
-            if not kill:
-                RETRIES += 1
-        if kill:
-            log.info("killing process...")
-            time.sleep(900)
-            ctrl.put(_STOP)
-            log.info("killed.")
-            break
+            delay = _backoff(args, RETRIES)
+            RETRIES += 1
+        METRICS.incr("reconnects")
+        log.info("reconnecting in {:.1f}s".format(delay))
+        until = time.monotonic() + delay
+        while not KILLED and time.monotonic() < until:
+            time.sleep(max(0, min(args.poll, until - time.monotonic())))
+
+
+def _requeue(args, q):
+    """Return undelivered outbound lines to the queue (on shutdown)."""
+    messages = []
+    for level, target, lines, stamp in OUTBOUND.drain():
+        obj = {}
+        obj[_TYPE] = [target]
+        if target == args.hostname:
+            obj[_TYPE] = [_PRIV_TYPE]
+        obj[_DATA] = "\n".join(lines)
+        obj[_RECV] = stamp
+        obj[_PRIORITY] = _PRIORITIES[level]
+        messages.append(obj)
+    if len(messages) == 0:
+        return
+    log.info("requeued outbound messages: " + str(len(messages)))
+    q.requeue(messages)
+
+
+def _stop_reactor(is_app, ctrl, background_thread, q):
+    """Stop the ingest thread and workers (reactor loop), then exit."""
+    ctrl.put(_STOP)
+    WORKERS.shutdown()
+    HANDLERS.shutdown()
+    background_thread.join()
+    _requeue(CONTEXT, q)
+    q.close()
+    _handle_app(is_app, "kill kill kill", 1)
+
+
+def _backoff(args, attempt):
+    """Reconnect delay, exponential in the attempt with full jitter."""
+    import random
+    delay = min(args.retry_max, args.retry * (2 ** min(attempt, 16)))
+    return random.uniform(0, delay)
+
+
+def _has_aio():
+    """Check the irc library provides the asyncio client."""
+    import importlib.util
+    try:
+        return importlib.util.find_spec("irc.client_aio") is not None
+    except ImportError:
+        # NOTE: the irc library itself is missing
+        return False
+
+
+def _ssl_context():
+    """SSL context for the event-driven loop (unverified, as wrap_socket)."""
+    import ssl
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def _aio_run(args, is_app):
+    """Execute the bot on an asyncio event loop."""
+    import asyncio
+    import zmq
+    global WAKE
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    wake = asyncio.Event()
+    q = Levels(args.spool,
+               args.spool_memory,
+               args.spool_segment,
+               args.priority_share)
+    METRICS.gauge("queued", q.__len__)
+    METRICS.gauge("outbound", OUTBOUND.pending)
+    sock = _bind_ingest(args)
+    fd = sock.getsockopt(zmq.FD)
+    chunks = Chunks(args.message_lines, args.chunk_timeout)
+    loop.add_reader(fd, _aio_ingest, args, sock, q, wake, chunks)
+    # NOTE: the zmq fd is edge-triggered, pick up anything already waiting
+    _aio_ingest(args, sock, q, wake, chunks)
+    # NOTE: abandoned transfers are closed even when nothing else arrives
+    loop.call_later(args.poll, _aio_expire, args, loop, q, wake, chunks)
+    with lock:
+        WAKE = functools.partial(loop.call_soon_threadsafe, wake.set)
+    try:
+        if args.pool > 1:
+            killed = loop.run_until_complete(_aio_pool(args, q, wake))
         else:
-            time.sleep(args.retry)
+            killed = loop.run_until_complete(_aio_bot(args, q, wake))
+    finally:
+        with lock:
+            WAKE = None
+        WORKERS.shutdown()
+        HANDLERS.shutdown()
+        loop.remove_reader(fd)
+        sock.close(linger=0)
+        loop.close()
+        _requeue(args, q)
+        q.close()
+        log.info("zmq ingest closed")
+    log.info("stopping...")
+    if killed:
+        _handle_app(is_app, "kill kill kill", 1)
+
+
+async def _aio_backoff(args, delay):
+    """Wait out a reconnect delay, only cut short when killed."""
+    import asyncio
+    until = time.monotonic() + delay
+    while not KILLED and time.monotonic() < until:
+        await asyncio.sleep(max(0, min(args.poll, until - time.monotonic())))
+
+
+async def _aio_bot(args, q, wake):
+    """Event-driven bot loop, returns True when killed."""
+    import asyncio
+    import irc.connection as conn
+    import irc.client_aio as client_aio
+    global READY
+    global RESET
+    global LAST_PONG
+    global RETRIES
+    loop = asyncio.get_event_loop()
+    while True:
+        c = None
+        with lock:
+            READY = False
+            RESET = False
+            LAST_PONG = time.monotonic()
+        try:
+            factory = conn.AioFactory(ssl=_ssl_context())
+            react = client_aio.AioReactor(loop=loop)
+            server = react.server()
+            c = await server.connect(args.server,
+                                     args.port,
+                                     args.name,
+                                     password=args.password,
+                                     connect_factory=factory)
+            c.add_global_handler("welcome", on_connect)
+            c.add_global_handler("pubmsg", on_message)
+            c.add_global_handler("pong", on_pong)
+            c.add_global_handler("disconnect", on_disconnect)
+            ping_at = loop.time() + args.ping
+            pinged = None
+            delay = None
+            while True:
+                timeout = max(0, ping_at - loop.time())
+                if delay is not None:
+                    timeout = min(timeout, delay)
+                try:
+                    await asyncio.wait_for(wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                wake.clear()
+                if _reloading():
+                    _reload([c])
+                with lock:
+                    if KILLED:
+                        return True
+                    delay = None
+                    if READY:
+                        while True:
+                            val = q.get(OUTBOUND.room(args.outbound_max))
+                            if val is None:
+                                break
+                            _send_lines(c,
+                                        _targets(args, val),
+                                        val[_DATA],
+                                        stamp=val.get(_RECV),
+                                        priority=_priority(val),
+                                        coalesce=val.get(_WHOLE, False))
+                        delay = OUTBOUND.flush(c)
+                    if RESET:
+                        raise SMIRCError("resetting...")
+                    if time.monotonic() - LAST_PONG > args.ping_timeout:
+                        raise SMIRCError("no recent pongs...")
+                if loop.time() >= ping_at:
+                    with lock:
+                        if pinged is not None and LAST_PONG < pinged:
+                            METRICS.incr("pong_misses")
+                    pinged = time.monotonic()
+                    ping_at = loop.time() + args.ping
+                    c.ping(args.hostname)
+        except Exception as e:
+            log.warning(e)
+            log.warning("will retry shortly")
+        if c is not None:
+            try:
+                c.disconnect("reconnecting...")
+            except Exception:
+                pass
+        with lock:
+            delay = _backoff(args, RETRIES)
+            RETRIES += 1
+        METRICS.incr("reconnects")
+        log.info("reconnecting in {:.1f}s".format(delay))
+        await _aio_backoff(args, delay)
+        with lock:
+            if KILLED:
+                return True
+
+
+class Member(object):
+    """Pool member, one of the bot's irc connections."""
+
+    def __init__(self, idx, name):
+        """Init the instance."""
+        self.idx = idx
+        self.name = name
+        self.conn = None
+        self.ready = False
+        self.last_pong = 0
+        self.retries = 0
+        self.down = None
+
+
+def _primary(pool):
+    """First connected pool member, the one acting on messages."""
+    for member in pool:
+        if member.ready:
+            return member
+    return None
+
+
+def _pool_connect(member, connection, event):
+    """On a pool member connection."""
+    log.info("connected " + member.name)
+    with lock:
+        member.ready = True
+        member.retries = 0
+        connection.join(CONTEXT.hostname)
+        for item in CONTEXT.rooms:
+            connection.join(item)
+    _wake()
+
+
+def _pool_message(pool, member, connection, event):
+    """On a pool member message, only the primary acts (once) on it."""
+    nick = str(event.source).split("!")[0]
+    with lock:
+        if nick in [x.name for x in pool] or _primary(pool) is not member:
+            return
+    on_message(connection, event)
+
+
+def _pool_pong(member, connection, event):
+    """PONG received by a pool member."""
+    log.debug(event)
+    with lock:
+        member.last_pong = time.monotonic()
+
+
+def _pool_disconnect(member, connection, event):
+    """On a pool member connection lost."""
+    log.info("disconnected " + member.name)
+    with lock:
+        member.ready = False
+    member.down.set()
+    _wake()
+
+
+async def _aio_member(args, pool, member):
+    """Keep a pool member connected (it never stops the pool)."""
+    import asyncio
+    import irc.connection as conn
+    import irc.client_aio as client_aio
+    loop = asyncio.get_event_loop()
+    member.down = asyncio.Event()
+    while True:
+        member.down.clear()
+        try:
+            factory = conn.AioFactory(ssl=_ssl_context())
+            react = client_aio.AioReactor(loop=loop)
+            server = react.server()
+            c = await server.connect(args.server,
+                                     args.port,
+                                     member.name,
+                                     password=args.password,
+                                     connect_factory=factory)
+            with lock:
+                member.conn = c
+                member.last_pong = time.monotonic()
+            c.add_global_handler("welcome",
+                                 functools.partial(_pool_connect, member))
+            c.add_global_handler("pubmsg",
+                                 functools.partial(_pool_message,
+                                                   pool,
+                                                   member))
+            c.add_global_handler("pong",
+                                 functools.partial(_pool_pong, member))
+            c.add_global_handler("disconnect",
+                                 functools.partial(_pool_disconnect, member))
+            pinged = None
+            while True:
+                try:
+                    await asyncio.wait_for(member.down.wait(), args.ping)
+                    raise SMIRCError("resetting " + member.name)
+                except asyncio.TimeoutError:
+                    pass
+                with lock:
+                    since = time.monotonic() - member.last_pong
+                    if since > args.ping_timeout:
+                        raise SMIRCError("no recent pongs " + member.name)
+                    if pinged is not None and member.last_pong < pinged:
+                        METRICS.incr("pong_misses")
+                pinged = time.monotonic()
+                c.ping(args.hostname)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning(e)
+            log.warning("will retry shortly")
+        with lock:
+            member.ready = False
+            c = member.conn
+            member.conn = None
+        if c is not None:
+            try:
+                c.disconnect("reconnecting...")
+            except Exception:
+                pass
+        with lock:
+            delay = _backoff(args, member.retries)
+            member.retries += 1
+        METRICS.incr("reconnects")
+        log.info("reconnecting {} in {:.1f}s".format(member.name, delay))
+        _wake()
+        await asyncio.sleep(delay)
+
+
+def _pool_restart(pool):
+    """Reconnect every pool member when a restart was requested."""
+    global RESET
+    if not RESET:
+        return
+    RESET = False
+    log.info("restarting pool...")
+    for member in pool:
+        if member.down is not None:
+            member.down.set()
+
+
+async def _aio_pool(args, q, wake):
+    """Event-driven loop over a pool of connections, returns when killed."""
+    import asyncio
+    loop = asyncio.get_event_loop()
+    pool = []
+    for idx in range(args.pool):
+        pool.append(Member(idx, "{}-{}".format(args.name, idx + 1)))
+    tasks = [loop.create_task(_aio_member(args, pool, x)) for x in pool]
+    METRICS.gauge("pool", lambda: len([x for x in pool if x.ready]))
+    delay = None
+    try:
+        while True:
+            try:
+                await asyncio.wait_for(wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            wake.clear()
+            if _reloading():
+                with lock:
+                    live = [x.conn for x in pool if x.ready]
+                _reload(live)
+            with lock:
+                if KILLED:
+                    return True
+                _pool_restart(pool)
+                delay = None
+                live = [x.conn for x in pool if x.ready]
+                if len(live) > 0:
+                    while True:
+                        val = q.get(OUTBOUND.room(args.outbound_max))
+                        if val is None:
+                            break
+                        _send_lines(live[0],
+                                    _targets(args, val),
+                                    val[_DATA],
+                                    stamp=val.get(_RECV),
+                                    priority=_priority(val),
+                                    coalesce=val.get(_WHOLE, False))
+                    delay = OUTBOUND.flush(live)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for member in pool:
+            if member.conn is not None:
+                try:
+                    member.conn.disconnect("stopping...")
+                except Exception:
+                    pass
+
 
 if __name__ == "__main__":
     main()
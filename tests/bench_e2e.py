@@ -0,0 +1,275 @@
+#!/usr/bin/python
+"""End-to-end benchmark, client sending() through the bot to irc privmsg."""
+import argparse
+import json
+import os
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SMIRC = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                     "..",
+                     "smirc",
+                     "smirc.py")
+TESTS = os.path.dirname(os.path.abspath(__file__))
+MODES = ["async", "reactor"]
+TRANSPORTS = ["tcp", "ipc"]
+PRODUCERS = 8
+MESSAGES = 100
+LARGE = 20
+LARGE_LINES = 100
+LARGE_WIDTH = 400
+COMMANDS = 200
+# NOTE: a scenario ends once every line arrived or nothing arrived for IDLE
+IDLE = 5
+TOLERANCE = 0.25
+
+
+def _prepare(tmp):
+    """Write the bot, using the benchmark irc server, into tmp."""
+    with open(SMIRC) as f:
+        src = f.read()
+    src = re.sub(r"(?m)^( *)import irc\.\w+ as",
+                 r"\1import bench_irc as",
+                 src)
+    src = src.replace("from systemd.journal import",
+                      "from logging import FileHandler as")
+    src = src.replace("JournalHandler(SYSLOG_IDENTIFIER='smirc')",
+                      "JournalHandler('{}')".format(os.path.join(tmp,
+                                                                 "bench.log")))
+    with open(os.path.join(tmp, "smirc_bench.py"), "w") as f:
+        f.write(src)
+
+
+def _free_port():
+    """Get an unused local port."""
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def _config(tmp, mode, transport):
+    """Write the bot config for a mode."""
+    cfg = {}
+    cfg["zmq"] = _free_port()
+    if transport == "ipc":
+        cfg["endpoint"] = "ipc://" + os.path.join(tmp, "bench.sock")
+    cfg["server"] = "localhost"
+    cfg["port"] = 6697
+    cfg["password"] = ""
+    cfg["joint"] = "#bench"
+    cfg["mode"] = mode
+    cfg["poll"] = 0.01
+    cfg["send"] = 30
+    # NOTE: measure the bot, not the flood limits of a real server
+    cfg["flood_rate"] = 0
+    cfg["outbound_max"] = 100000
+    cfg["worker_backlog"] = COMMANDS
+    cfg["commands"] = {"bench": "echo"}
+    path = os.path.join(tmp, "bench.json")
+    with open(path, "w") as f:
+        f.write(json.dumps(cfg))
+    return path
+
+
+def _deliveries(output, scenario):
+    """Read (latency, time) deliveries of a scenario."""
+    results = []
+    if not os.path.exists(output):
+        return results
+    with open(output) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 4 and parts[0] == scenario:
+                results.append((float(parts[2]), float(parts[3])))
+    return results
+
+
+def _wait(output, scenario, expected):
+    """Wait for the deliveries of a scenario."""
+    count = -1
+    idle = time.monotonic() + IDLE
+    while time.monotonic() < idle:
+        results = _deliveries(output, scenario)
+        if len(results) >= expected:
+            break
+        if len(results) != count:
+            count = len(results)
+            idle = time.monotonic() + IDLE
+        time.sleep(0.05)
+    return _deliveries(output, scenario)
+
+
+def _summary(results, expected, started):
+    """Summarize the deliveries of a scenario."""
+    obj = {}
+    obj["sent"] = expected
+    obj["delivered"] = len(results)
+    if len(results) == 0:
+        return obj
+    latency = sorted([x[0] for x in results])
+    elapsed = max([x[1] for x in results]) - started
+    obj["seconds"] = round(elapsed, 3)
+    obj["rate"] = round(len(results) / max(elapsed, 0.001), 2)
+    obj["p50"] = round(latency[len(latency) // 2] * 1000, 2)
+    obj["p99"] = round(latency[int(len(latency) * 0.99)] * 1000, 2)
+    obj["max"] = round(latency[-1] * 1000, 2)
+    return obj
+
+
+def _line(scenario, idx):
+    """Bench line, timestamped as it is handed to sending()."""
+    return "bench {} {} {}".format(scenario, idx, time.time())
+
+
+def _concurrent(mod, args, cfg):
+    """Many producers sending at once."""
+    def _producer(base):
+        for idx in range(base, base + MESSAGES):
+            mod.sending(args, [_line("concurrent", idx)])
+    threads = []
+    for p in range(PRODUCERS):
+        thread = threading.Thread(target=_producer, args=(p * MESSAGES,))
+        threads.append(thread)
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return PRODUCERS * MESSAGES
+
+
+def _large(mod, args, cfg):
+    """Large multi-line payloads."""
+    pad = "x" * LARGE_WIDTH
+    for msg in range(LARGE):
+        base = msg * LARGE_LINES
+        lines = ["{} {}".format(_line("large", base + idx), pad)
+                 for idx in range(LARGE_LINES)]
+        mod.sending(args, ["\n".join(lines)])
+    return LARGE * LARGE_LINES
+
+
+def _commands(mod, args, cfg):
+    """Command burst, replies come back from the worker pool."""
+    for idx in range(COMMANDS):
+        mod.sending(args, ["!bench " + _line("commands", idx)])
+    return COMMANDS
+
+
+def _pipelined(mod, args, cfg):
+    """One persistent client sending without waiting on each ack."""
+    with mod.Client(config=cfg, private=True) as client:
+        client.send_many([_line("pipelined", idx)
+                          for idx in range(PRODUCERS * MESSAGES)])
+        client.wait()
+    return PRODUCERS * MESSAGES
+
+
+SCENARIOS = [("concurrent", _concurrent),
+             ("large", _large),
+             ("commands", _commands),
+             ("pipelined", _pipelined)]
+
+
+def _mode(tmp, mod, mode, transport):
+    """Benchmark the bot in one loop mode."""
+    cfg = _config(tmp, mode, transport)
+    output = os.path.join(tmp, "bench.{}.out".format(mode))
+    env = dict(os.environ)
+    env["SMIRC_BENCH_OUTPUT"] = output
+    env["PYTHONPATH"] = os.pathsep.join([TESTS, env.get("PYTHONPATH", "")])
+    bot = subprocess.Popen([sys.executable,
+                            "smirc_bench.py",
+                            "--bot",
+                            "--config",
+                            cfg],
+                           cwd=tmp,
+                           env=env,
+                           stdout=subprocess.DEVNULL)
+    results = {}
+    try:
+        args = mod.client_args(["--config", cfg, "--private"])[0]
+        mod.sending(args, [_line("warmup", 0)])
+        if len(_wait(output, "warmup", 1)) == 0:
+            raise Exception("bot did not start ({})".format(mode))
+        for name, fxn in SCENARIOS:
+            started = time.time()
+            expected = fxn(mod, args, cfg)
+            results[name] = _summary(_wait(output, name, expected),
+                                     expected,
+                                     started)
+        results["bot"] = mod.stats(args)
+    finally:
+        bot.send_signal(signal.SIGTERM)
+        try:
+            bot.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+    return results
+
+
+def _regressions(results, baseline, tolerance):
+    """Compare results to a baseline, returns the regressions."""
+    found = []
+    for mode in results:
+        for name, _ in SCENARIOS:
+            now = results[mode].get(name, {})
+            then = baseline.get(mode, {}).get(name, {})
+            if "rate" not in then:
+                continue
+            if now.get("delivered", 0) < then["delivered"]:
+                found.append("{} {} delivered {} < {}".format(
+                    mode, name, now.get("delivered", 0), then["delivered"]))
+            if now.get("rate", 0) < then["rate"] * (1 - tolerance):
+                found.append("{} {} rate {} < {}".format(
+                    mode, name, now.get("rate", 0), then["rate"]))
+            if now.get("p99", 0) > then["p99"] * (1 + tolerance):
+                found.append("{} {} p99 {}ms > {}ms".format(
+                    mode, name, now.get("p99", 0), then["p99"]))
+    return found
+
+
+def main():
+    """Run the benchmark, results are printed (and written) as json."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=MODES, action="append")
+    parser.add_argument("--transport", choices=TRANSPORTS, default="tcp")
+    parser.add_argument("--output", type=str)
+    parser.add_argument("--baseline", type=str)
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    opts = parser.parse_args()
+    tmp = tempfile.mkdtemp()
+    try:
+        _prepare(tmp)
+        sys.path.insert(0, tmp)
+        import smirc_bench
+        results = {}
+        for mode in opts.mode or MODES:
+            results[mode] = _mode(tmp, smirc_bench, mode, opts.transport)
+    finally:
+        shutil.rmtree(tmp)
+    text = json.dumps(results, indent=4, sort_keys=True)
+    print(text)
+    if opts.output is not None:
+        with open(opts.output, "w") as f:
+            f.write(text)
+    if opts.baseline is not None:
+        with open(opts.baseline) as f:
+            baseline = json.loads(f.read())
+        found = _regressions(results, baseline, opts.tolerance)
+        for item in found:
+            print("regression: " + item)
+        if len(found) > 0:
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/env/python
+"""Benchmark IRC server (mock), records delivery latency of bench lines."""
+import os
+import re
+import threading
+import time
+import mock_irc_client
+import mock_irc_client_aio
+import mock_irc_connection
+
+OUTPUT = os.environ.get("SMIRC_BENCH_OUTPUT", "bench.out")
+_BENCH = re.compile(r"^bench (\w+) (\d+) ([\d.]+)")
+# NOTE: the bot imports this module in place of every irc module
+Factory = mock_irc_connection.Factory
+AioFactory = mock_irc_connection.AioFactory
+
+
+class Connection(mock_irc_client.Connection):
+    """Mock connection, bench lines are recorded as they are sent."""
+
+    def __init__(self):
+        """Init the connection."""
+        super().__init__()
+        self._out = open(OUTPUT, "a", buffering=1)
+        self._lock = threading.Lock()
+
+    def join(self, channel):
+        """Join a channel."""
+        pass
+
+    def privmsg(self, target, datum):
+        """Send a message, recording the latency of bench lines."""
+        now = time.time()
+        match = _BENCH.match(datum)
+        if match is not None:
+            with self._lock:
+                self._out.write("{} {} {} {}\n".format(
+                    match.group(1),
+                    match.group(2),
+                    now - float(match.group(3)),
+                    now))
+
+    def close(self):
+        """Close the recording."""
+        self._out.close()
+
+
+class Client(mock_irc_client.Client):
+    """Mock client, sending over the recording connection."""
+
+    def _connection(self):
+        """Create the connection."""
+        return Connection()
+
+    def disconnect(self, message=""):
+        """Disconnect (mock)."""
+        self._conn.close()
+
+    def _process(self):
+        """Process a request, nothing but the welcome."""
+        if not self._welcomed:
+            self._welcomed = True
+            self._send(mock_irc_client.Event(type="welcome"))
+
+
+class Server(mock_irc_client.Server):
+    """Server object, runs until the bot is stopped (no script)."""
+
+    def _client(self):
+        """Create the client."""
+        return Client()
+
+    def _process(self):
+        """Mock processing."""
+        self._c._process()
+
+
+class Reactor(mock_irc_client.Reactor):
+    """Reactor object (mock)."""
+
+    def __init__(self):
+        """Init the instance."""
+        self._s = Server()
+
+
+class AioServer(mock_irc_client_aio.AioServer, Server):
+    """Server object (mock asyncio)."""
+
+    pass
+
+
+class AioReactor(mock_irc_client_aio.AioReactor):
+    """Reactor object (mock asyncio)."""
+
+    def __init__(self, loop=None):
+        """Init the instance."""
+        self.loop = loop
+        self._s = AioServer(self)
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+"""Client startup benchmark (process fork/exec through to the bot's ack)."""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zmq
+
+RUNS = 25
+SMIRC = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                     "..",
+                     "smirc",
+                     "smirc.py")
+
+
+def _acker(sock, stop):
+    """Ack client messages until stopped."""
+    poller = zmq.Poller()
+    poller.register(sock, zmq.POLLIN)
+    while not stop.is_set():
+        if poller.poll(100):
+            frames = sock.recv_multipart()
+            sock.send_multipart(frames[:-1] + [b"ack"])
+
+
+def _time(cmd, data=None):
+    """Time a command, in milliseconds, over all runs."""
+    times = []
+    for i in range(RUNS):
+        start = time.monotonic()
+        subprocess.run(cmd,
+                       input=data,
+                       stdout=subprocess.DEVNULL,
+                       check=True)
+        times.append((time.monotonic() - start) * 1000)
+    times.sort()
+    result = {}
+    result["mean"] = round(sum(times) / len(times), 2)
+    result["p50"] = round(times[len(times) // 2], 2)
+    result["p90"] = round(times[int(len(times) * 0.9)], 2)
+    return result
+
+
+def main():
+    """Run the benchmark, results are printed as json."""
+    context = zmq.Context()
+    sock = context.socket(zmq.ROUTER)
+    port = sock.bind_to_random_port("tcp://127.0.0.1")
+    stop = threading.Event()
+    thread = threading.Thread(target=_acker, args=(sock, stop))
+    thread.start()
+    try:
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as f:
+            cfg = {}
+            cfg["zmq"] = port
+            cfg["send"] = 5
+            cfg["modules"] = {"mod": "module.py"}
+            f.write(json.dumps(cfg))
+            f.flush()
+            results = {}
+            results["runs"] = RUNS
+            results["interpreter"] = _time([sys.executable, "-c", "pass"])
+            results["client"] = _time([sys.executable,
+                                       SMIRC,
+                                       "--config",
+                                       f.name],
+                                      data=b"benchmark\n")
+        print(json.dumps(results, indent=4))
+    finally:
+        stop.set()
+        thread.join()
+        sock.close(linger=0)
+
+
+if __name__ == "__main__":
+    main()
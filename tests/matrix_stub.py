@@ -0,0 +1,127 @@
+#!/usr/bin/python
+"""Matrix bridge check against a local http stub."""
+import http.server
+import importlib.util
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+POSTS = []
+PORTS = set()
+DELAY = [0]
+
+
+class Stub(http.server.BaseHTTPRequestHandler):
+    """Homeserver stub."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        """Record a posted event."""
+        time.sleep(DELAY[0])
+        length = int(self.headers["Content-Length"])
+        POSTS.append(json.loads(self.rfile.read(length).decode("utf-8")))
+        PORTS.add(self.client_address[1])
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, format, *args):
+        """Quiet."""
+        pass
+
+
+class Event(object):
+    """Message event."""
+
+    def __init__(self, text):
+        """Init the event."""
+        self.source = "user"
+        self.target = "#mock"
+        self.arguments = [text]
+
+
+def _bridge(env):
+    """Load a bridge module instance."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "..",
+                        "extensions",
+                        "matrix_bridge.py")
+    spec = importlib.util.spec_from_file_location("bridge", path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    mod.Module._env = env
+    mod.Module._window = 0.2
+    return mod.Module
+
+
+def _wait(count):
+    """Wait for posts."""
+    for i in range(50):
+        if len(POSTS) >= count:
+            return
+        time.sleep(0.1)
+
+
+def main():
+    """Run the checks."""
+    log = logging.getLogger("matrix")
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Stub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    with tempfile.NamedTemporaryFile("w") as f:
+        f.write('SYNAPSE_HOST="http://127.0.0.1:{}"\n'.format(
+            server.server_address[1]))
+        f.write('SYNAPSE_API_TOKEN="token"\n')
+        f.write('SYNAPSE_IRC_BRIDGE="!room"\n')
+        f.flush()
+        module = _bridge(f.name)
+        bridge = module()
+        for i in range(5):
+            bridge.handle(None, Event("line" + str(i)), log)
+        _wait(1)
+        if len(POSTS) != 1 or POSTS[0]["body"].count("\n") != 4:
+            print("matrix bridge did not batch")
+            exit(1)
+        bridge.handle(None, Event("again"), log)
+        _wait(2)
+        if len(POSTS) != 2 or len(PORTS) != 1:
+            print("matrix bridge did not keep the connection alive")
+            exit(1)
+        DELAY[0] = 1
+        module._queue = 2
+        slow = module()
+        for i in range(10):
+            slow.handle(None, Event("slow" + str(i)), log)
+        if slow.dropped == 0:
+            print("matrix bridge did not drop on overflow")
+            exit(1)
+        warned = []
+        handler = logging.Handler()
+        handler.emit = warned.append
+        log.addHandler(handler)
+        module._queue = 1
+        module._notify = 0.2
+        single = module()
+        for i in range(5):
+            single.handle(None, Event("single" + str(i)), log)
+        if single.dropped == 0 or len(warned) != 1:
+            print("matrix bridge did not log drops")
+            exit(1)
+        time.sleep(0.3)
+        for i in range(2):
+            single.handle(None, Event("later" + str(i)), log)
+        log.removeHandler(handler)
+        total = "dropped: {}".format(single.dropped)
+        if len(warned) != 2 or not warned[-1].getMessage().endswith(total):
+            print("matrix bridge did not throttle drop logs")
+            exit(1)
+    server.shutdown()
+    print("matrix bridge ok")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,8 @@ import os
 log = logging.getLogger("mock")
 log.addHandler(logging.FileHandler("mock.log"))
 log.setLevel(logging.INFO)
+# NOTE: one channel, every client (e.g. pool members) sees every message
+_CLIENTS = []
 
 
 class Reactor(object):
@@ -44,12 +46,12 @@ class Connection(object):
 class Event(object):
     """Mock event."""
 
-    def __init__(self):
+    def __init__(self, type="pubmsg"):
         """Init the mock event."""
         self.target = "#mock"
         self.arguments = []
-        self.type = "pubmsg"
-        self.source = ""
+        self.type = type
+        self.source = "tester!tester@localhost"
 
 
 class Server(object):
@@ -57,13 +59,17 @@ class Server(object):
 
     def __init__(self):
         """Init the mock server."""
-        self._c = Client()
+        self._c = self._client()
         self._idx = 0
         self._name = None
 
+    def _client(self):
+        """Create the client."""
+        return Client()
+
     def connect(self, server, port, name, password=None, connect_factory=None):
         """Mock connection."""
-        self._name = "#" + name.replace("-bot", "")
+        self._name = "#" + name.split("-bot")[0]
         return self._c
 
     def _process(self):
@@ -73,7 +79,7 @@ class Server(object):
             self._c.privmsg(self._name, "!killkillkill")
         self._idx += 1
         self._c._process()
-        if is_stop:
+        if is_stop and os.path.exists("running.tmp"):
             os.remove("running.tmp")
 
 
@@ -82,33 +88,50 @@ class Client(object):
 
     def __init__(self):
         """Init the client."""
-        self._handlers = []
-        self._conn = Connection()
+        self._handlers = {}
+        self._conn = self._connection()
         self._evt = Event()
+        self._welcomed = False
+        _CLIENTS.append(self)
+
+    def _connection(self):
+        """Create the connection."""
+        return Connection()
 
     def privmsg(self, targets, datum):
         """Send a private message."""
         self._conn.privmsg(targets, datum)
         evt = Event()
         evt.target = targets
-        evt.arguments = datum.split(" ")
-        self._send(evt)
+        evt.arguments = [datum]
+        for client in list(_CLIENTS):
+            client._send(evt)
 
     def add_global_handler(self, name, function):
         """Add a handler."""
-        self._handlers.append(function)
+        if name not in self._handlers:
+            self._handlers[name] = []
+        self._handlers[name].append(function)
 
     def ping(self, host):
         """Do a ping."""
         log.info("ping")
         log.info(host)
+        self._send(Event(type="pong"))
+
+    def disconnect(self, message=""):
+        """Disconnect (mock)."""
+        log.info("disconnect")
 
     def _process(self):
         """Process a request."""
         log.info('process')
+        if not self._welcomed:
+            self._welcomed = True
+            self._send(Event(type="welcome"))
         self._send(self._evt)
 
     def _send(self, evt):
         """Send data to handlers."""
-        for item in self._handlers:
+        for item in self._handlers.get(evt.type, []):
             item(self._conn, evt)
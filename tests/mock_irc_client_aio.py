@@ -0,0 +1,45 @@
+#!/usr/env/python
+"""Mock IRC asyncio client."""
+from mock_irc_client import Server
+
+TICK = 2
+
+
+class AioReactor(object):
+    """Reactor object (mock asyncio)."""
+
+    def __init__(self, loop=None):
+        """Init the instance."""
+        self.loop = loop
+        self._s = AioServer(self)
+
+    def server(self):
+        """Get a mock server."""
+        return self._s
+
+
+class AioServer(Server):
+    """Server object (mock asyncio)."""
+
+    def __init__(self, reactor):
+        """Init the mock server."""
+        super().__init__()
+        self._reactor = reactor
+
+    async def connect(self,
+                      server,
+                      port,
+                      name,
+                      password=None,
+                      connect_factory=None):
+        """Mock connection."""
+        c = Server.connect(self, server, port, name, password=password)
+        self._reactor.loop.call_later(TICK, self._tick)
+        return c
+
+    def _tick(self):
+        """Mock processing on the event loop."""
+        if self._idx > 6:
+            return
+        self._process()
+        self._reactor.loop.call_later(TICK, self._tick)
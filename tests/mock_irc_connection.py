@@ -8,3 +8,11 @@ class Factory(object):
     def __init__(self, wrapper=None):
         """Init an empty factory."""
         pass
+
+
+class AioFactory(object):
+    """Mock asyncio factory."""
+
+    def __init__(self, **kwargs):
+        """Init an empty factory."""
+        pass
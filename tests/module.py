@@ -4,9 +4,13 @@
 class Module(object):
     """Loadable module."""
 
+    channels = ["#mock"]
+
     def handle(self, connection, event, log):
         """Handle events."""
         log.info('handle')
+        if "boom" in " ".join(event.arguments):
+            raise Exception("boom")
 
     def execute(self, connection, target, subcmds, log):
         """Execute the module."""
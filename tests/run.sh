@@ -1,21 +1,151 @@
 #!/bin/bash
 RUNNING="running.tmp"
 exit_code=0
-cat ../smirc/smirc.py | sed "s/^import irc\./import mock_irc\_/g;s/from systemd\.journal.*//g;s/.*JournalHandler.*/log.addHandler(logging.FileHandler('test.log'))/g" > smirc_test.py
+CONFIG="test.json"
+if [ $# -gt 0 ]; then
+    # NOTE: key=value pairs override the test config
+    CONFIG="test.override.json"
+    python -c '#!/usr/bin/python
+import json
+import sys
+
+with open("test.json") as f:
+    cfg = json.loads(f.read())
+for arg in sys.argv[2:]:
+    kv = arg.split("=", 1)
+    try:
+        cfg[kv[0]] = json.loads(kv[1])
+    except ValueError:
+        cfg[kv[0]] = kv[1]
+with open(sys.argv[1], "w") as f:
+    f.write(json.dumps(cfg))
+' $CONFIG $@
+    cp test.json.local $CONFIG.local
+fi
+cat ../smirc/smirc.py | sed "s/^\( *\)import irc\./\1import mock_irc\_/g;s/\"irc\.client_aio\"/\"mock_irc_client_aio\"/g;s/from systemd\.journal import/from logging import FileHandler as/g;s/JournalHandler(SYSLOG_IDENTIFIER='smirc')/JournalHandler('test.log')/g" > smirc_test.py
 rm -f *.log
+rm -rf spool.tmp spool.test smirc.ipc profile.tmp
 rm -f $RUNNING
 touch "$RUNNING"
-python smirc_test.py --bot --config test.json &
+python smirc_test.py --bot --config $CONFIG &
+BOT=$!
 echo "harness running..."
 sleep 1
 _test_command() {
-echo "!$1" | python smirc_test.py --config test.json
+echo "!$1" | python smirc_test.py --config $CONFIG
 }
 _test_command "status"
+echo "!profile start" | python smirc_test.py --config $CONFIG --private
+python -c '#!/usr/bin/python
+import smirc_test
+
+args = smirc_test.client_args(["--config", "'$CONFIG'"])[0]
+args.name = "other-bot"
+args.aggregate = False
+args.aggregator = smirc_test._endpoint(args, False)
+smirc_test.CONTEXT = args
+smirc_test._fleet_reply(None, "#mock", "!status", "alive: old")
+'
+_test_command "slow 5"
+printf "stream-a\nstream-b" | python smirc_test.py --config $CONFIG --stream
+python -c '#!/usr/bin/python
+import smirc_test
+
+with smirc_test.Client(config="'$CONFIG'") as client:
+    client.send_many(["repeat 1", "repeat 2", "repeat 3"])
+    client.wait(timeout=10)
+'
+printf "/dev/sda1 20G 11G\n/dev/sda2 40G 31G\n/dev/sda3 80G 41G\n" | python smirc_test.py --config $CONFIG
+seq 1 200 | sed "s/^/chunked /g" | python smirc_test.py --config $CONFIG --private
+python -c '#!/usr/bin/python
+import smirc_test
+
+args = smirc_test.client_args(["--config", "'$CONFIG'", "--private"])[0]
+socket = smirc_test._client_socket(args)
+data = "\n".join(["abandoned {}".format(x) for x in range(1, 11)])
+if not smirc_test._client_send(socket,
+                               args,
+                               data,
+                               chunk=("abandoned", 0, True)):
+    exit(1)
+'
+echo "boom" | python smirc_test.py --config $CONFIG
+_test_command "ttl +%s%N"
+_test_command 'lines %s\n alpha beta gamma delta epsilon'
+_test_command "stats"
+_test_command "debug"
+touch module.py
+echo "!reload" | python smirc_test.py --config $CONFIG --private
+kill -HUP $BOT
 python -c '#!/usr/bin/python
 import smirc_test
 
-smirc_test.run(config="test.json", arguments=["!mod"])
+args = smirc_test.client_args(["--config",
+                               "'$CONFIG'",
+                               "--private",
+                               "--priority",
+                               "bulk"])[0]
+for idx in range(30):
+    letters = "".join([chr(ord("a") + int(x)) for x in str(idx)])
+    smirc_test.sending(args, ["bulk " + letters])
+smirc_test.run(config="'$CONFIG'",
+               arguments=["--private", "critical alert"],
+               priority="critical")
+'
+python -c '#!/usr/bin/python
+import io
+import smirc_test
+
+args = smirc_test.client_args(["--config", "'$CONFIG'", "--private"])[0]
+if not smirc_test.sending(args, None, stream=io.StringIO("stringio 1\n")):
+    exit(1)
+'
+if [ $? -ne 0 ]; then
+    echo "file-like input failed"
+    exit_code=1
+fi
+python -c '#!/usr/bin/python
+import asyncio
+import smirc_test
+
+with smirc_test.Client(config="'$CONFIG'", private=True) as client:
+    client.send_many(["client a", "client b"])
+    if not client.wait(timeout=10):
+        exit(1)
+
+
+async def _aio():
+    client = smirc_test.AioClient(config="'$CONFIG'", private=True)
+    await client.send("client aio")
+    acked = await client.wait(timeout=10)
+    client.close()
+    return acked
+
+if not asyncio.new_event_loop().run_until_complete(_aio()):
+    exit(1)
+'
+if [ $? -ne 0 ]; then
+    echo "pipelined client failed"
+    exit_code=1
+fi
+if grep -q '"ingest": "pull"' $CONFIG; then
+    echo "!profile stop" | python smirc_test.py --config $CONFIG --private
+else
+    python smirc_test.py --config $CONFIG --profile stop | grep -q "^profile stopping, writing: "
+    if [ $? -ne 0 ]; then
+        echo "profile stop failed"
+        exit_code=1
+    fi
+    python smirc_test.py --config $CONFIG --stats | grep '"ingested"' > /dev/null
+    if [ $? -ne 0 ]; then
+        echo "stats query failed"
+        exit_code=1
+    fi
+fi
+python -c '#!/usr/bin/python
+import smirc_test
+
+smirc_test.run(config="'$CONFIG'", arguments=["!mod"])
 try:
     smirc_test.run(config="/invalid/path/config.json", arguments=["!mod"])
 except smirc_test.SMIRCError as e:
@@ -51,13 +181,548 @@ _requires()
         fi
     done
 }
-_requires 0 "alive connected __VERSION__ stopping !killkillkill #mock zmq loading module handle dict_keys"
+_requires 0 "alive connected __VERSION__ stopping !killkillkill #mock zmq loading module handle dict_keys stream-a stream-b uptime client.a client.b client.aio critical.alert stringio.1"
 _requires 1 "sending Resource Address will #original"
-cat *.log | grep -F -q "dict_keys(['!mod', '!test'])"
+cat *.log | grep -F -q "dict_keys(['!mod', '!test', '!ttl', '!slow', '!lines'])"
 if [ $? -ne 0 ]; then
     echo "missing required module/command loads"
     exit_code=1
 fi
+cat *.log | grep -q "^repeat 3 (repeated 2x"
+if [ $? -ne 0 ]; then
+    echo "missing coalesced repeats"
+    exit_code=1
+fi
+if [ $(cat mock.log | grep "^/dev/sda[123] [0-9]*G [0-9]*G$" | sort -u | wc -l) -ne 3 ]; then
+    echo "missing multi-line message lines"
+    exit_code=1
+fi
+_transfer()
+{
+    for l in "$@"; do
+        grep -x -F -q "$l" mock.log
+        if [ $? -ne 0 ]; then
+            echo "missing transfer line: $l"
+            exit_code=1
+        fi
+    done
+}
+_transfer "chunked 1" "chunked 2" "chunked 3" \
+    "... 194 of 200 lines truncated ..." \
+    "chunked 198" "chunked 199" "chunked 200"
+_transfer "abandoned 1" "abandoned 2" "abandoned 3" \
+    "... 4 of 10 lines truncated (incomplete) ..." \
+    "abandoned 8" "abandoned 9" "abandoned 10"
+if [ $(cat mock.log | grep "^chunked " | sort -u | wc -l) -ne 6 ]; then
+    echo "unexpected chunked message lines"
+    exit_code=1
+fi
+cat *.log | grep -q "^module mod disabled for 60s: boom"
+if [ $? -ne 0 ]; then
+    echo "missing module circuit breaker"
+    exit_code=1
+fi
+if [ $(cat mock.log | grep "^[0-9]\{19\}$" | sort -u | wc -l) -ne 1 ]; then
+    echo "missing cached command output"
+    exit_code=1
+fi
+if [ $(cat mock.log | grep -c "^reloaded, changed: nothing") -ne 2 ]; then
+    echo "missing config reloads"
+    exit_code=1
+fi
+python -c '#!/usr/bin/python
+import threading
+import time
+import smirc_test
+
+
+class Conn(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def privmsg(self, target, line):
+        self.sent.append(line)
+
+
+args = smirc_test.client_args(["--config", "'$CONFIG'"])[0]
+smirc_test.CONTEXT = args
+args.rooms.append("#other")
+if smirc_test._aggregating("#other") or \
+   not smirc_test._aggregating(args.joint):
+    exit(1)
+relayed = []
+smirc_test._fleet_reply = lambda c, ch, cmd, text: relayed.append((cmd, text))
+conn = Conn()
+cmd = smirc_test.Command(True, {"path": "sh", "ttl": 60})
+subcmd = ["-c", "sleep 1; echo shared"]
+relay = smirc_test.Relay(conn, args.joint, "!lead")
+lead = threading.Thread(target=smirc_test._proc_cmd,
+                        args=(cmd, relay, [args.joint], subcmd))
+lead.start()
+time.sleep(0.3)
+relay = smirc_test.Relay(conn, args.joint, "!waiter")
+smirc_test._proc_cmd(cmd, relay, [args.joint], subcmd)
+lead.join()
+if sorted(relayed) != [("!lead", "shared"), ("!waiter", "shared")] or \
+   len(conn.sent) > 0:
+    exit(1)
+'
+if [ $? -ne 0 ]; then
+    echo "shared command reply skipped the aggregator"
+    exit_code=1
+fi
+python -c '#!/usr/bin/python
+import time
+import smirc_test
+
+
+class Conn(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def privmsg(self, target, line):
+        self.sent.append(line)
+
+
+class Event(object):
+
+    def __init__(self, target):
+        self.target = target
+
+
+args = smirc_test.client_args(["--config", "'$CONFIG'"])[0]
+args.commands = ["!test"]
+args.hostname = "host-bot"
+smirc_test.CONTEXT = args
+relayed = []
+smirc_test._fleet_reply = lambda c, ch, cmd, text: relayed.append(cmd)
+smirc_test.WORKERS = smirc_test.Workers(2, 4)
+conn = Conn()
+event = Event(args.joint)
+for action in [smirc_test._help, smirc_test._stats, smirc_test._debug]:
+    action(conn, event, [])
+time.sleep(0.3)
+if sorted(relayed) != ["!debug", "!help", "!stats"] or len(conn.sent) > 0:
+    exit(1)
+'
+if [ $? -ne 0 ]; then
+    echo "builtin reply skipped the aggregator"
+    exit_code=1
+fi
+cat mock.log | grep -F -q "alive: old (other-bot)"
+if [ $? -ne 0 ]; then
+    echo "missing fleet summary"
+    exit_code=1
+fi
+cat mock.log | grep -q "^fleet !status: missing .*gone-bot"
+if [ $? -ne 0 ]; then
+    echo "missing fleet hosts"
+    exit_code=1
+fi
+if [ $(ls profile.tmp/*.collapsed profile.tmp/*.txt | wc -l) -ne 2 ]; then
+    echo "missing profile report"
+    exit_code=1
+fi
+cat *.log | grep -q "^profile written: "
+if [ $? -ne 0 ]; then
+    echo "missing profile log"
+    exit_code=1
+fi
+cat *.log | grep -q "^not permitted user requested: !debug"
+if [ $? -ne 0 ]; then
+    echo "missing acl denial"
+    exit_code=1
+fi
+python -c '#!/usr/bin/python
+import json
+import time
+import zmq
+import smirc_test
+
+ctx = zmq.Context()
+pull = ctx.socket(zmq.PULL)
+pull.bind("inproc://drain")
+push = ctx.socket(zmq.PUSH)
+push.connect("inproc://drain")
+messages = [{"type": ["#mock"], "data": "first"},
+            {"type": ["#mock"], "data": "x", "chunk": ["a"], "more": True},
+            {"type": ["#mock"], "data": "x", "chunk": "a", "seq": "1"},
+            {"type": ["#mock"], "data": "x", "chunk": "a", "seq": None},
+            {"type": ["#mock"], "data": ["x"]},
+            {"type": "#mock", "data": "x"},
+            {"type": ["#mock"], "data": "last"}]
+for message in messages:
+    push.send(json.dumps(message).encode("utf-8"))
+push.send(b"{")
+time.sleep(0.2)
+batch = smirc_test._drain_ingest(pull, "pull", smirc_test.Chunks())
+counters = smirc_test.METRICS.snapshot()["counters"]
+if [x["data"] for x in batch] != ["first", "last"]:
+    exit(1)
+if counters["invalid"] != 6:
+    exit(1)
+'
+if [ $? -ne 0 ]; then
+    echo "malformed messages did not drop cleanly"
+    exit_code=1
+fi
+python -c '#!/usr/bin/python
+import time
+import smirc_test
+
+
+class Conn(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def privmsg(self, target, line):
+        self.sent.append(line)
+
+
+out = smirc_test.Outbound(0, 1, coalesce=1)
+out.push_message("#mock", ["a"])
+time.sleep(0.4)
+out.push_message("#mock", ["b"])
+out.push_message("#mock", ["b"])
+time.sleep(0.1)
+out.push_message("#mock", ["a"])
+conn = Conn()
+out.flush(conn)
+time.sleep(0.65)
+# NOTE: the repeat of a must not hold its window open behind b
+out.flush(conn)
+if len(conn.sent) != 3 or not conn.sent[2].startswith("a (repeated 1x"):
+    exit(1)
+'
+if [ $? -ne 0 ]; then
+    echo "coalesced repeat held its window open"
+    exit_code=1
+fi
+python -c '#!/usr/bin/python
+import smirc_test
+
+
+class Conn(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def privmsg(self, target, line):
+        self.sent.append(line)
+
+
+q = smirc_test.Levels(share=0.1)
+q.extend([{"data": "bulk", "priority": "bulk"} for x in range(30)])
+q.put({"data": "critical", "priority": "critical"})
+if q.get()["data"] != "critical":
+    exit(1)
+out = smirc_test.Outbound(0, 1)
+for x in range(30):
+    out.push("#mock", "bulk", priority=3)
+out.push("#mock", "critical", priority=0)
+conn = Conn()
+out.flush(conn)
+if conn.sent.index("critical") != 0 or len(conn.sent) != 31:
+    exit(1)
+'
+if [ $? -ne 0 ]; then
+    echo "critical message did not go first"
+    exit_code=1
+fi
+python -c '#!/usr/bin/python
+import smirc_test
+
+ran = []
+guard = smirc_test.Guard("g", timeout=10, failures=1, backlog=2)
+for idx in range(4):
+    guard.submit(lambda key, idx=idx: ran.append((idx, key)))
+if [x[0] for x in ran] != [0]:
+    exit(1)
+guard.leave(ran[0][1])
+guard.leave(ran[1][1])
+if [x[0] for x in ran] != [0, 1, 2]:
+    exit(1)
+guard.submit(lambda key: ran.append(("waiting", key)))
+guard.leave(ran[2][1], error=Exception("failed"))
+if ran[-1] != ("waiting", None) or guard.submit(ran.append):
+    exit(1)
+'
+if [ $? -ne 0 ]; then
+    echo "module backlog failed"
+    exit_code=1
+fi
+python -c '#!/usr/bin/python
+import os
+import smirc_test
+
+path = "spool.test"
+spool = smirc_test.Spool(path, memory=2, segment=2)
+spool.extend([{"data": str(x)} for x in range(7)])
+if sorted(os.listdir(path)) != ["000000000000.spool",
+                                "000000000001.spool",
+                                "000000000002.spool"]:
+    exit(1)
+taken = [spool.get()["data"] for x in range(3)]
+spool.close()
+if taken != ["0", "1", "2"] or "cursor" not in os.listdir(path):
+    exit(1)
+spool = smirc_test.Spool(path, memory=2, segment=2)
+if len(spool) != 4:
+    exit(1)
+rest = []
+while len(spool) > 0:
+    rest.append(spool.get()["data"])
+if rest != ["3", "4", "5", "6"] or len(os.listdir(path)) != 0:
+    exit(1)
+args = smirc_test.Ctx()
+args.hostname = "vm-bot"
+smirc_test.OUTBOUND = smirc_test.Outbound(0, 1)
+smirc_test.OUTBOUND.push("#mock", "unsent 1", stamp=1)
+smirc_test.OUTBOUND.push("vm-bot", "unsent 2", stamp=2, priority=0)
+smirc_test.OUTBOUND.push("#mock", "unsent 3", stamp=3)
+q = smirc_test.Levels(path, memory=2, segment=2)
+q.extend([{"type": ["pub"], "data": "spooled"}])
+smirc_test._requeue(args, q)
+q.close()
+q = smirc_test.Levels(path, memory=2, segment=2)
+got = []
+while len(q) > 0:
+    val = q.get()
+    got.append((val["type"], val["data"]))
+if got != [(["priv"], "unsent 2"),
+           (["#mock"], "unsent 1\nunsent 3"),
+           (["pub"], "spooled")]:
+    exit(1)
+'
+if [ $? -ne 0 ]; then
+    echo "spool recovery failed"
+    exit_code=1
+fi
+python -c '#!/usr/bin/python
+import asyncio
+import random
+import time
+import mock_irc_client
+import smirc_test
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+args = smirc_test.Ctx()
+args.retry = 1
+args.retry_max = 30
+for attempt in range(20):
+    random.seed(attempt)
+    delay = smirc_test._backoff(args, attempt)
+    random.seed(attempt)
+    if delay != smirc_test._backoff(args, attempt) or \
+       not 0 <= delay <= min(30, 2 ** attempt):
+        exit(1)
+clock = Clock()
+smirc_test.time = clock
+pings = []
+
+
+def _ping(self, host):
+    # NOTE: never answered, each ping takes half the timeout
+    pings.append(host)
+    clock.now += 31
+
+
+mock_irc_client.Client.ping = _ping
+args.server = "mock"
+args.port = 6667
+args.password = None
+args.hostname = "#pool"
+args.ping = 0.01
+args.ping_timeout = 60
+args.retry = 60
+args.retry_max = 60
+member = smirc_test.Member(0, "pool-1")
+
+
+async def _live():
+    task = asyncio.get_event_loop().create_task(
+        smirc_test._aio_member(args, [member], member))
+    for idx in range(100):
+        await asyncio.sleep(0.01)
+        if smirc_test.METRICS.snapshot()["counters"].get("reconnects"):
+            break
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+random.seed(1)
+asyncio.new_event_loop().run_until_complete(_live())
+counters = smirc_test.METRICS.snapshot()["counters"]
+if len(pings) != 2 or counters.get("reconnects") != 1 or member.retries != 1:
+    exit(1)
+'
+if [ $? -ne 0 ]; then
+    echo "backoff/liveness failed"
+    exit_code=1
+fi
+cat *.log | grep -q "^reconnecting pool-1 in 8\.1s"
+if [ $? -ne 0 ]; then
+    echo "missing reconnect after missed pongs"
+    exit_code=1
+fi
+python -c '#!/usr/bin/python
+import threading
+import time
+import smirc_test
+
+
+class Hanging(object):
+
+    def __init__(self):
+        self.name = "hang"
+        self.guard = smirc_test.Guard(self.name,
+                                      timeout=0.2,
+                                      failures=2,
+                                      cooldown=1)
+        self.calls = []
+        self.release = threading.Event()
+
+    def handle(self, connection, event, log):
+        self.calls.append(event)
+        if event == "hang":
+            self.release.wait()
+
+
+smirc_test.HANDLERS = smirc_test.Workers(4, 8)
+mod = Hanging()
+try:
+    for event in ["hang", "hang"]:
+        smirc_test._submit_handle(mod, None, event)
+        time.sleep(0.3)
+    # NOTE: both hung calls failed (and freed the slot), the breaker is open
+    started = time.monotonic()
+    smirc_test._submit_handle(mod, None, "refused")
+    if time.monotonic() - started > 0.1 or mod.calls != ["hang", "hang"]:
+        exit(1)
+    time.sleep(1.1)
+    smirc_test._submit_handle(mod, None, "recovered")
+    time.sleep(0.1)
+    if mod.calls[-1] != "recovered":
+        exit(1)
+finally:
+    mod.release.set()
+    smirc_test.HANDLERS.shutdown()
+'
+if [ $? -ne 0 ]; then
+    echo "hung module did not recover"
+    exit_code=1
+fi
+python -c '#!/usr/bin/python
+import asyncio
+import time
+import mock_irc_client_aio
+import smirc_test
+
+attempts = []
+
+
+async def _refused(self, *args, **kwargs):
+    attempts.append(time.monotonic())
+    raise OSError("refused")
+
+
+mock_irc_client_aio.AioServer.connect = _refused
+smirc_test._backoff = lambda args, attempt: 0.5
+args = smirc_test.Ctx()
+args.server = "mock"
+args.port = 6667
+args.name = "backoff-bot"
+args.password = None
+args.poll = 0.1
+
+
+async def _traffic(wake):
+    # NOTE: ingested messages wake the loop, the backoff must hold
+    for idx in range(26):
+        wake.set()
+        await asyncio.sleep(0.05)
+    smirc_test.KILLED = True
+
+
+async def _backoff():
+    wake = asyncio.Event()
+    traffic = asyncio.get_event_loop().create_task(_traffic(wake))
+    killed = await smirc_test._aio_bot(args, None, wake)
+    await traffic
+    return killed
+
+if not asyncio.new_event_loop().run_until_complete(_backoff()):
+    exit(1)
+gaps = [b - a for a, b in zip(attempts, attempts[1:])]
+if len(attempts) > 3 or min(gaps) < 0.45:
+    exit(1)
+'
+if [ $? -ne 0 ]; then
+    echo "reconnect backoff cut short"
+    exit_code=1
+fi
+python -c '#!/usr/bin/python
+import asyncio
+import smirc_test
+
+pool = [smirc_test.Member(x, "pool-{}".format(x)) for x in range(2)]
+for member in pool:
+    member.down = asyncio.Event()
+smirc_test._pool_restart(pool)
+if any([x.down.is_set() for x in pool]):
+    exit(1)
+smirc_test.RESET = True
+smirc_test._pool_restart(pool)
+if smirc_test.RESET or not all([x.down.is_set() for x in pool]):
+    exit(1)
+'
+if [ $? -ne 0 ]; then
+    echo "pool restart failed"
+    exit_code=1
+fi
+cat mock.log | grep -q "^\.\.\. 3 of 5 lines truncated \.\.\."
+if [ $? -ne 0 ]; then
+    echo "missing command output cap"
+    exit_code=1
+fi
+python -c '#!/usr/bin/python
+import time
+import smirc_test
+
+started = time.monotonic()
+text = smirc_test._shell(["sh", "-c", "echo closing; exec >&- 2>&-; sleep 6"], 1)
+if time.monotonic() - started > 3 or \
+   text != "closing\ncommand timed out after 1s":
+    exit(1)
+'
+if [ $? -ne 0 ]; then
+    echo "detached command outlived its timeout"
+    exit_code=1
+fi
+cat *.log | grep -F -q "command timed out after 1s"
+if [ $? -ne 0 ]; then
+    echo "missing command timeout"
+    exit_code=1
+fi
+python matrix_stub.py
+if [ $? -ne 0 ]; then
+    echo "matrix bridge failed"
+    exit_code=1
+fi
 
 if [ $exit_code -gt 0 ]; then
     echo "test faillure reported"